@@ -1,36 +1,67 @@
+import json
+import sys
+import threading
+import uuid
+from collections import OrderedDict
+
 import dash
 from dash import dcc, html
 from dash.dependencies import Input, Output, State
 
-import openai
-import os
-import numpy as np
-import pandas as pd
-
+from catalogs import DEFAULT_CATALOG, get_registry
 from chat_bot import HardCodedBouncerBot, ReceptionChatBot, ReceptionSummarizerBot, RecommenderChatBot
-from search import SimpleCosineSimilarity
-
-# Read OpenAI API key from environment variable
-openai.api_key = os.getenv("OPENAI_API_KEY")
+from openai_api import get_scheduler, hedging_metrics
+from startup import get_search_algo, timer, warm_up
 
 N_RSEARCH_RESULTS = 5
+N_CANDIDATES = 500 # Candidates kept for re-ranking when the user refines their request
+HEDGE_REQUESTS = False # Issue duplicate API requests when a call is slower than usual
+MAX_SESSIONS = 100 # Conversations kept in memory, the least recently used ones are dropped
+
+# Load default catalog in the background, so the app can respond right away
+warm_up_thread = warm_up(catalog=DEFAULT_CATALOG, hedge=HEDGE_REQUESTS)
+
+# Conversation state per browser session, least recently used first
+sessions = OrderedDict()
+sessions_lock = threading.Lock()
+
+def new_session(catalog):
+    """
+    Returns the state of a new conversation about a catalog: its own chat bots and conversation history,
+    and the recommender and candidate pool once the search is done. Only the name of the catalog is kept,
+    not its search algorithm, so that the catalog registry can evict it.
+    """
+    return {
+        "catalog": catalog,
+        "receptionist": ReceptionChatBot(hedge=HEDGE_REQUESTS),
+        "bouncer": HardCodedBouncerBot(stop_phrases=["start search"]),
+        "summarizer": ReceptionSummarizerBot(hedge=HEDGE_REQUESTS),
+        "refiner": HardCodedBouncerBot(stop_phrases=["refine search"]),
+        "conversation_history": [],
+        "recommendation": {}
+    }
 
-# Read data & embeddings
-df = pd.read_csv("data/musiccaps-public.csv")
-embeddings = np.load("embeddings/aggregated_embeddings.npy")
-
-# Instantiate search algo
-search_algo = SimpleCosineSimilarity()
-search_algo.read_database(
-    embeddings=embeddings,
-    captions=df["caption"].tolist(),
-    track_names=df["ytid"].tolist()
-)
-
-# Instantiate chat bots
-receptionist = ReceptionChatBot()
-bouncer = HardCodedBouncerBot(stop_phrases=["start search"])
-summarizer = ReceptionSummarizerBot()
+def get_session(session_id, catalog):
+    """
+    Returns the conversation state of a browser session. A new reception is started if the session
+    is unknown or the user chose another catalog.
+    """
+    with sessions_lock:
+        session = sessions.get(session_id)
+        if session is None or session["catalog"] != catalog:
+            session = new_session(catalog)
+        sessions[session_id] = session
+        sessions.move_to_end(session_id)
+        while len(sessions) > MAX_SESSIONS:
+            sessions.popitem(last=False)
+    return session
+
+def reset_session(session_id):
+    """
+    Drops the conversation state of a browser session, so that its next message starts a new reception.
+    """
+    with sessions_lock:
+        sessions.pop(session_id, None)
 
 # Instantiate the Dash app
 external_stylesheets = [
@@ -39,38 +70,84 @@ external_stylesheets = [
 
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 
-# Define the layout of the app
-app.layout = html.Div(
-    [
-        html.H1("Music Search Chatbot", className="app-title"),
-        html.Div(id="conversation", className="conversation-container"),
-        html.Div(
-            [
-                dcc.Input(
-                    id="user-input",
-                    type="text",
-                    placeholder="Enter your message...",
-                    className="user-input-container"
-                ),
-                html.Button("Send", id="send-button", n_clicks=0, className="send-button"),
-            ],
-            className="input-container"
-        ),
-    ],
-    className="app-container"
-)
-
-# Store conversation history
-conversation_history = []
+# Expose live rate limit metrics (queue depth and remaining budget per model) and hedging metrics
+@app.server.route("/metrics")
+def metrics():
+    body = {"rate_limits": get_scheduler().metrics(), "hedging": hedging_metrics(), "catalogs": get_registry().metrics()}
+    return json.dumps(body), 200, {"Content-Type": "application/json"}
+
+# Define the layout of the app. It is served per page load, so that every browser session gets its own id.
+def serve_layout():
+    return html.Div(
+        [
+            html.H1("Music Search Chatbot", className="app-title"),
+            dcc.Store(id="session-id", data=str(uuid.uuid4())),
+            dcc.Dropdown(
+                id="catalog",
+                options=[{"label": name, "value": name} for name in get_registry().names()],
+                value=DEFAULT_CATALOG,
+                clearable=False,
+                className="catalog-dropdown"
+            ),
+            html.Div(id="conversation", className="conversation-container"),
+            html.Div(
+                [
+                    dcc.Input(
+                        id="user-input",
+                        type="text",
+                        placeholder="Enter your message...",
+                        className="user-input-container"
+                    ),
+                    html.Button("Send", id="send-button", n_clicks=0, className="send-button"),
+                    html.Button("New search", id="new-search-button", n_clicks=0, className="send-button"),
+                ],
+                className="input-container"
+            ),
+        ],
+        className="app-container"
+    )
+
+app.layout = serve_layout
 
 # Define the callback function
 @app.callback(
     [Output("conversation", "children"), Output("user-input", "value")],
-    [Input("send-button", "n_clicks")],
-    [State("user-input", "value")]
+    [Input("send-button", "n_clicks"), Input("new-search-button", "n_clicks")],
+    [State("user-input", "value"), State("catalog", "value"), State("session-id", "data")]
 )
-def handle_user_interaction(n_clicks, user_input):
+def handle_user_interaction(n_clicks, new_search_clicks, user_input, catalog, session_id):
+    if "new-search-button.n_clicks" in [trigger["prop_id"] for trigger in dash.callback_context.triggered]:
+        # Go back to the receptionist
+        reset_session(session_id)
+        return "", ""
+
+    session = get_session(session_id, catalog)
+    conversation_history = session["conversation_history"]
+    recommendation = session["recommendation"]
+
+    if user_input and recommendation:
+        # Re-rank candidate pool and refresh the search results only if the user asks for it
+        refiner = session["refiner"]
+        recommender = recommendation["recommender"]
+        recommender.messages.append({"role": "user", "content": user_input})
+        refiner.read_conversation(recommender.messages)
+        follow_up = refiner.remove_stop_phrases(user_input)
+        if refiner.is_job_done() and follow_up:
+            # Looked up in the registry on every refinement, so that sessions do not keep evicted catalogs alive
+            search_algo = get_search_algo(session["catalog"], hedge=HEDGE_REQUESTS)
+            recommendation["pool"], (indices, names, captions) = search_algo.refine(
+                recommendation["pool"], follow_up, n=N_RSEARCH_RESULTS
+            )
+            recommender.update_results(names, captions)
+
+        response = recommender.get_response()
+        conversation_history.append({"role": "user", "content": user_input})
+        conversation_history.append({"role": "assistant", "content": response})
+
+        return [render_message(message) for message in conversation_history], ""
+
     if user_input:
+        receptionist, bouncer, summarizer = session["receptionist"], session["bouncer"], session["summarizer"]
         receptionist.messages.append({"role": "user", "content": user_input})
         # Check if conversation is done
         bouncer.read_conversation(receptionist.messages)
@@ -89,17 +166,21 @@ def handle_user_interaction(n_clicks, user_input):
             summarizer.read_conversation(receptionist.messages)
             summary = summarizer.summarize()
 
-            # Do search
-            indices, names, captions = search_algo.find_similar(summary, n=N_RSEARCH_RESULTS)
+            # Do search, keeping a larger candidate pool for refinements
+            search_algo = get_search_algo(catalog, hedge=HEDGE_REQUESTS)
+            pool = search_algo.find_candidates(summary, pool_size=N_CANDIDATES)
+            indices, names, captions = pool.top(N_RSEARCH_RESULTS)
 
             # Instantiate recommender
             recommender = RecommenderChatBot(
                 names=names,
                 descriptions=captions,
-                user_input=summary
+                user_input=summary,
+                hedge=HEDGE_REQUESTS
             )
 
             response = recommender.get_response()
+            recommendation.update(recommender=recommender, pool=pool)
 
             # Append user input, assistant response, and summary to conversation history
             conversation_history.append({"role": "user", "content": user_input})
@@ -166,4 +247,7 @@ def render_message(message):
 
 
 if __name__ == "__main__":
+    if "--startup-report" in sys.argv:
+        warm_up_thread.join()
+        print(timer.report())
     app.run_server(debug=True)
\ No newline at end of file
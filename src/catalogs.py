@@ -0,0 +1,309 @@
+"""
+Registry of named music catalogs served from one process.
+
+Each catalog has its own database files and `SearchAlgorithm`. Catalogs are loaded on first use
+and the least recently used ones are evicted when the loaded catalogs exceed a memory budget.
+Besides the default MusicCaps catalog, catalogs can be registered in a JSON file:
+
+    {
+        "jazz": {
+            "csv_path": "data/jazz.csv",
+            "embeddings_path": "embeddings/jazz_embeddings.npy",
+            "snapshot_path": "embeddings/jazz_snapshot.npz",
+            "name_column": "title",
+            "caption_column": "description"
+        }
+    }
+
+A catalog may name its own `SearchAlgorithm` subclass as "module:ClassName" in "search_algorithm".
+The class is instantiated with the `hedge` keyword if its constructor accepts it and without
+arguments otherwise. Its database is read with `read_database(embeddings, captions, track_names)`;
+when the catalog is read from its snapshot, `normalized=True` is passed as well if the method
+accepts it (the base class does), since the snapshot holds L2-normalized float32 embeddings.
+"""
+
+import importlib
+import inspect
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from typing import List
+
+import numpy as np
+
+from snapshot import (CLUSTERS_PATH, CSV_PATH, EMBEDDINGS_PATH, SNAPSHOT_PATH, build_snapshot, is_snapshot_current,
+                      load_catalog, load_snapshot)
+from startup import timer
+
+DEFAULT_CATALOG = "musiccaps"
+CATALOGS_CONFIG_PATH = os.getenv("CATALOGS_CONFIG", "catalogs.json")
+MEMORY_BUDGET_MB = float(os.getenv("CATALOG_MEMORY_BUDGET_MB", "1024"))
+
+
+def _accepts(function, keyword: str) -> bool:
+    """
+    Returns whether a function or class can be called with the given keyword argument.
+    """
+    parameters = inspect.signature(function).parameters.values()
+    return any(p.name == keyword or p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters)
+
+
+def search_algo_memory(search_algo) -> int:
+    """
+    Estimates the number of bytes held by the database of a search algorithm.
+
+    :param search_algo: A search algorithm whose database has been read.
+    :type search_algo: SearchAlgorithm
+    :return: The estimated number of bytes.
+    :rtype: int
+    """
+    size = 0
+    for value in vars(search_algo).values():
+        if isinstance(value, np.ndarray):
+            size += value.nbytes
+        elif isinstance(value, list):
+            size += sys.getsizeof(value) + sum(sys.getsizeof(item) for item in value)
+    return size
+
+
+class Catalog:
+
+    def __init__(self, name: str, csv_path: str, embeddings_path: str, snapshot_path: str = None,
+                 clusters_path: str = None, name_column: str = "ytid", caption_column: str = "caption",
+                 search_algorithm: str = "search:SimpleCosineSimilarity"):
+        """
+        Initializes the description of a catalog. Nothing is loaded until `load` is called.
+
+        :param name: The unique name of the catalog.
+        :type name: str
+        :param csv_path: Path of the catalog CSV.
+        :type csv_path: str
+        :param embeddings_path: Path of the aggregated embeddings.
+        :type embeddings_path: str
+        :param snapshot_path: Path of the warm snapshot. Defaults to None (always read the CSV).
+        :type snapshot_path: str
+        :param clusters_path: Path of the near-duplicate cluster mapping. Defaults to None.
+        :type clusters_path: str
+        :param name_column: Column with the unique track names. Defaults to "ytid".
+        :type name_column: str
+        :param caption_column: Column with the track captions. Defaults to "caption".
+        :type caption_column: str
+        :param search_algorithm: The SearchAlgorithm subclass as "module:ClassName". Defaults to SimpleCosineSimilarity.
+        :type search_algorithm: str
+        """
+        self.name = name
+        self.csv_path = csv_path
+        self.embeddings_path = embeddings_path
+        self.snapshot_path = snapshot_path
+        self.clusters_path = clusters_path
+        self.name_column = name_column
+        self.caption_column = caption_column
+        self.search_algorithm = search_algorithm
+
+    def load(self, hedge: bool = False):
+        """
+        Instantiates the search algorithm and reads the catalog into it, from the warm snapshot if it exists
+        and its sources are unchanged.
+
+        :param hedge: Whether the search algorithm hedges its embedding calls. Ignored if its constructor
+            has no `hedge` keyword. Defaults to False.
+        :type hedge: bool
+        :return: The search algorithm with its database read.
+        :rtype: SearchAlgorithm
+        """
+        module_name, class_name = self.search_algorithm.split(":")
+        cls = getattr(importlib.import_module(module_name), class_name)
+        search_algo = cls(hedge=hedge) if _accepts(cls, "hedge") else cls()
+
+        use_snapshot = bool(self.snapshot_path) and os.path.exists(self.snapshot_path)
+        if use_snapshot and not is_snapshot_current(self.snapshot_path, self.csv_path, self.embeddings_path,
+                                                    self.clusters_path, self.name_column, self.caption_column):
+            print(f"Warning: the snapshot of catalog '{self.name}' is outdated (its sources changed or it was built by an older version). "
+                  f"Reading the CSV instead. Run 'python snapshot.py {self.name}' to rebuild it.")
+            use_snapshot = False
+
+        if use_snapshot:
+            with timer.measure(f"load snapshot of '{self.name}'"):
+                embeddings, captions, track_names = load_snapshot(self.snapshot_path)
+                kwargs = {"normalized": True} if _accepts(search_algo.read_database, "normalized") else {}
+                search_algo.read_database(embeddings=embeddings, captions=captions, track_names=track_names, **kwargs)
+        else:
+            if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+                print(f"No snapshot found for catalog '{self.name}'. Run 'python snapshot.py {self.name}' for a fast start.")
+            with timer.measure(f"load csv & embeddings of '{self.name}'"):
+                embeddings, captions, track_names, _ = load_catalog(
+                    self.csv_path, self.embeddings_path, self.clusters_path, self.name_column, self.caption_column)
+                search_algo.read_database(embeddings=embeddings, captions=captions, track_names=track_names)
+        return search_algo
+
+    def build_snapshot(self) -> None:
+        """
+        Builds the warm snapshot of the catalog.
+        """
+        if not self.snapshot_path:
+            raise ValueError(f"Catalog '{self.name}' has no snapshot path.")
+        build_snapshot(self.csv_path, self.embeddings_path, self.clusters_path, self.snapshot_path,
+                       self.name_column, self.caption_column)
+
+
+class CatalogRegistry:
+
+    def __init__(self, memory_budget_mb: float = MEMORY_BUDGET_MB):
+        """
+        Initializes an empty registry.
+
+        :param memory_budget_mb: Memory budget of all loaded catalogs in megabytes. The least recently used
+            catalogs are evicted when it is exceeded. The catalog in use is never evicted. The budget covers
+            the search indexes only, not the candidate pools of sessions. Defaults to 1024.
+        :type memory_budget_mb: float
+        """
+        self.memory_budget = memory_budget_mb * 1e6
+        self._catalogs = {}
+        self._loaded = OrderedDict()  # name -> (search algorithm, bytes), least recently used first
+        self._load_locks = {}
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "loads": 0, "evictions": 0}
+
+    def register(self, catalog: Catalog) -> None:
+        """
+        Registers a catalog. A loaded catalog of the same name is evicted.
+
+        :param catalog: The catalog.
+        :type catalog: Catalog
+        """
+        with self._lock:
+            self._catalogs[catalog.name] = catalog
+            self._load_locks.setdefault(catalog.name, threading.Lock())
+            self._loaded.pop(catalog.name, None)
+
+    def names(self) -> List[str]:
+        """
+        Returns the names of all registered catalogs.
+        """
+        with self._lock:
+            return list(self._catalogs)
+
+    def catalog(self, name: str) -> Catalog:
+        """
+        Returns the description of a registered catalog.
+        """
+        with self._lock:
+            if name not in self._catalogs:
+                raise KeyError(f"Unknown catalog '{name}'. Registered catalogs: {', '.join(self._catalogs)}.")
+            return self._catalogs[name]
+
+    def get(self, name: str = DEFAULT_CATALOG, hedge: bool = False):
+        """
+        Returns the search algorithm of a catalog, loading it on first use and evicting least recently
+        used catalogs if the memory budget is exceeded. An evicted search algorithm is only freed once
+        nobody holds a reference to it, so callers should keep the catalog name and call `get` again
+        instead of keeping the search algorithm.
+
+        :param name: The name of the catalog. Defaults to DEFAULT_CATALOG.
+        :type name: str
+        :param hedge: Whether the search algorithm hedges its embedding calls. Only used when the catalog is loaded.
+        :type hedge: bool
+        :return: The search algorithm with its database read.
+        :rtype: SearchAlgorithm
+        """
+        catalog = self.catalog(name)
+        with self._lock:
+            if name in self._loaded:
+                self._loaded.move_to_end(name)
+                self.counters["hits"] += 1
+                return self._loaded[name][0]
+            load_lock = self._load_locks[name]
+
+        # Load outside of the registry lock, so that other catalogs stay available meanwhile
+        with load_lock:
+            with self._lock:
+                if name in self._loaded:
+                    self._loaded.move_to_end(name)
+                    self.counters["hits"] += 1
+                    return self._loaded[name][0]
+            search_algo = catalog.load(hedge=hedge)
+            size = search_algo_memory(search_algo)
+            with self._lock:
+                self._loaded[name] = (search_algo, size)
+                self.counters["loads"] += 1
+                self._evict(keep=name)
+        return search_algo
+
+    def _evict(self, keep: str) -> None:
+        """
+        Evicts least recently used catalogs until the memory budget is met. Must be called with the lock held.
+        """
+        used = sum(size for _, size in self._loaded.values())
+        for name in list(self._loaded):
+            if used <= self.memory_budget:
+                break
+            if name == keep:
+                continue
+            used -= self._loaded.pop(name)[1]
+            self.counters["evictions"] += 1
+
+    def evict(self, name: str) -> None:
+        """
+        Evicts a catalog if it is loaded.
+        """
+        with self._lock:
+            if self._loaded.pop(name, None) is not None:
+                self.counters["evictions"] += 1
+
+    def metrics(self) -> dict:
+        """
+        Returns the loaded catalogs (least recently used first), their memory and the cache counters.
+        """
+        with self._lock:
+            return {
+                "loaded": {name: size for name, (_, size) in self._loaded.items()},
+                "memory_bytes": sum(size for _, size in self._loaded.values()),
+                "memory_budget_bytes": self.memory_budget,
+                **self.counters,
+            }
+
+
+def load_registry(config_path: str = CATALOGS_CONFIG_PATH, memory_budget_mb: float = MEMORY_BUDGET_MB) -> CatalogRegistry:
+    """
+    Creates a registry with the default MusicCaps catalog and the catalogs of the config file, if it exists.
+
+    :param config_path: Path of the JSON config with catalogs by name. Defaults to $CATALOGS_CONFIG or "catalogs.json".
+    :type config_path: str
+    :param memory_budget_mb: Memory budget in megabytes. Defaults to $CATALOG_MEMORY_BUDGET_MB or 1024.
+    :type memory_budget_mb: float
+    :return: The registry.
+    :rtype: CatalogRegistry
+    """
+    registry = CatalogRegistry(memory_budget_mb=memory_budget_mb)
+    registry.register(Catalog(
+        name=DEFAULT_CATALOG,
+        csv_path=CSV_PATH,
+        embeddings_path=EMBEDDINGS_PATH,
+        snapshot_path=SNAPSHOT_PATH,
+        clusters_path=CLUSTERS_PATH
+    ))
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            for name, config in json.load(f).items():
+                registry.register(Catalog(name=name, **config))
+    return registry
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> CatalogRegistry:
+    """
+    Returns the catalog registry of this process, creating it on first use.
+
+    :return: The registry.
+    :rtype: CatalogRegistry
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = load_registry()
+        return _registry
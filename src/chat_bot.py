@@ -1,9 +1,9 @@
-import openai
-import os
+import re
 from abc import ABC, abstractmethod
 from typing import Dict, Any, List
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+from openai_api import chat_completion, completion
+from rate_limit import Priority
 
 
 ##################
@@ -93,7 +93,8 @@ class ReceptionBouncerBot(BouncerBot):
 
         i = 0
         while True:
-            response = openai.Completion.create(
+            response = completion(
+                priority = Priority.INTERACTIVE,
                 model = "text-davinci-003",
                 prompt = f"{self.prompt_start}\n{self.prompt_mid}\n{self.prompt_end}\n",
                 max_tokens = 10,
@@ -154,6 +155,19 @@ class HardCodedBouncerBot(BouncerBot):
             if phrase in self.final_message.lower():
                 return True
         return False
+
+    def remove_stop_phrases(self, text: str) -> str:
+        """
+        Returns the text without the stop phrases, e.g. to keep only what the user wrote after a trigger phrase.
+
+        :param text: The text, usually the final message.
+        :type text: str
+        :return: The text without the stop phrases and surrounding punctuation.
+        :rtype: str
+        """
+        for phrase in self.stop_phrases:
+            text = re.sub(re.escape(phrase), " ", text, flags=re.IGNORECASE)
+        return text.strip(" :,.-")
         
             
 #####################
@@ -197,18 +211,18 @@ class SummarizerBot(ABC):
 
 class ReceptionSummarizerBot(SummarizerBot):
     
-    def __init__(self):
+    def __init__(self, hedge: bool = False):
         """
         Initializes a ReceptionSummarizerBot object.
-        This function does not take any parameters.
 
         Parameters:
-        None
+        hedge (bool): Whether to hedge API calls against tail latency. Defaults to False.
 
         Return:
         None
         """
         self.name = "ReceptionSummarizerBot"
+        self.hedge = hedge
         self.prompt_start = """
         The following is a conversation between a user looking for music and a chatbot
         """
@@ -240,7 +254,9 @@ class ReceptionSummarizerBot(SummarizerBot):
         Takes no parameters. Returns a string containing the generated response.
         """
         
-        response = openai.Completion.create(
+        response = completion(
+            priority = Priority.SUMMARIZATION,
+            hedge = self.hedge,
             model = "text-davinci-003",
             prompt = f"{self.prompt_start}\n{self.prompt_mid}\n{self.prompt_end}\n",
             temperature = 0.5,
@@ -298,12 +314,12 @@ class ChatBot(ABC):
         
 class ReceptionChatBot(ChatBot):
     
-    def __init__(self):
+    def __init__(self, hedge: bool = False):
         """
         Initializes a new instance of the ReceptionBot class.
 
         Parameters:
-        None.
+        hedge (bool): Whether to hedge API calls against tail latency. Defaults to False.
 
         Returns:
         None.
@@ -317,6 +333,7 @@ class ReceptionChatBot(ChatBot):
         The message is then added to a list of messages that the bot can send to the user.
         """
         self.name = "ReceptionBot"
+        self.hedge = hedge
         self.system_msg = """
         You are a music discovery receptionist AI. The user tells you what music he is looking for. Your response follows a clear structure
         1. repeat the users request in a summarized way
@@ -335,7 +352,9 @@ class ReceptionChatBot(ChatBot):
             response_text (str): The response generated by the model.
         """
         
-        response = openai.ChatCompletion.create(
+        response = chat_completion(
+            priority=Priority.INTERACTIVE,
+            hedge=self.hedge,
             model="gpt-3.5-turbo",
             messages=self.messages,
             temperature = 0.7,
@@ -361,40 +380,56 @@ class ReceptionChatBot(ChatBot):
 
 class RecommenderChatBot(ChatBot):
     
-    def __init__(self, names: List[str], descriptions: List[str], user_input: str, max_caption_length: int = 500):
+    def __init__(self, names: List[str], descriptions: List[str], user_input: str, max_caption_length: int = 500, hedge: bool = False):
         """
         Initializes a RecommenderBot instance with a given list of music names and descriptions, a user input string, and a maximum caption length.
         :param names: A list of strings representing music names.
         :param descriptions: A list of strings representing music descriptions.
         :param user_input: A string representing the user's request.
         :param max_caption_length: An optional integer representing the maximum length of the music descriptions. Defaults to 500.
+        :param hedge: Whether to hedge API calls against tail latency. Defaults to False.
         """
         
         self.name = "RecommenderBot"
+        self.hedge = hedge
         self.max_caption_length = max_caption_length
-        self.system_msg = """
+        self.system_msg_start = """
         A search algorithm send you some music that the user may like. You are an assistant that recommends music to the user based on their request.
         The user will start the conversation by repeating his request. Be brief and stick exclusively to the exact search results.
+        If the user wants different music, tell them to type 'refine search' followed by what should change. The search results are updated then.
         Search results:
         """
-        
+
+        self.messages = [
+            {"role": "system", "content": ""},
+            {"role": "user", "content": f"I am looking for the following kind of music: {user_input}"}
+            ]
+        self.update_results(names, descriptions)
+
+    def update_results(self, names: List[str], descriptions: List[str]) -> None:
+        """
+        Replaces the search results in the system message in place, keeping the rest of the conversation.
+
+        :param names: A list of strings representing music names.
+        :param descriptions: A list of strings representing music descriptions.
+        :return: None
+        """
+        self.system_msg = self.system_msg_start
         for name, description in zip(names, descriptions):
             # Truncate description if needed
             if len(description) > self.max_caption_length:
                 description = description[:self.max_caption_length] + "..."
             self.system_msg += f"\n{name}: {description}"
-
-        self.messages = [
-            {"role": "system", "content": f"{self.system_msg}"},
-            {"role": "user", "content": f"I am looking for the following kind of music: {user_input}"}
-            ]
+        self.messages[0]["content"] = f"{self.system_msg}"
         
     def get_response(self) -> str:
         """
         Retrieves a response from the GPT-3.5-Turbo model using the provided messages as context.
         :return: A string representing the response generated by the model.
         """
-        response = openai.ChatCompletion.create(
+        response = chat_completion(
+            priority=Priority.INTERACTIVE,
+            hedge=self.hedge,
             model="gpt-3.5-turbo",
             messages=self.messages,
             temperature = 0.7,
@@ -1,10 +1,22 @@
 import pandas as pd
-import openai
 import os
+import sys
 import numpy as np
 from tqdm import tqdm
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import openai_api
+from rate_limit import DEFAULT_BUDGETS, Priority, RateLimitScheduler
+from deduplicate import DUPLICATE_THRESHOLD, find_near_duplicates
+
+# Budgets are per process and there is no priority between this job and the serving processes:
+# they only share the account quota. Keep the share of this job small so that chats are not
+# rate limited while it runs. Set BULK_BUDGET_SHARE=1 when nothing else is serving.
+BULK_BUDGET_SHARE = float(os.getenv("BULK_BUDGET_SHARE", "0.1"))
+openai_api.set_scheduler(RateLimitScheduler(budgets={
+    model: {key: value * BULK_BUDGET_SHARE for key, value in budget.items()}
+    for model, budget in DEFAULT_BUDGETS.items()
+}))
 
 # Load data
 df = pd.read_csv("../data/musiccaps-public.csv")
@@ -19,7 +31,8 @@ for i, caption in tqdm(enumerate(captions)):
     target_path = f"individual_embeddings/embedding_{names[i]}.npy"
     if os.path.exists(target_path):
         continue
-    response = openai.Embedding.create(
+    response = openai_api.embedding(
+        priority=Priority.BULK,
         input=captions[i],
         model="text-embedding-ada-002"
     )
@@ -42,4 +55,10 @@ for i, name in enumerate(names):
 embeddings = embeddings.astype(np.float16)
 np.save("aggregated_embeddings.npy", embeddings)
     
-print("\nEmbeddings aggregated!")
\ No newline at end of file
+print("\nEmbeddings aggregated!")
+
+# Cluster near-duplicates. Only one representative per cluster is kept in the search index.
+clusters = find_near_duplicates(embeddings, threshold=DUPLICATE_THRESHOLD)
+np.save("duplicate_clusters.npy", clusters)
+
+print(f"\nNear-duplicates clustered! {len(np.unique(clusters))} of {len(clusters)} tracks kept in the search index.")
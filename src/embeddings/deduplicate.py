@@ -0,0 +1,46 @@
+import numpy as np
+
+DUPLICATE_THRESHOLD = 0.98
+
+
+def find_near_duplicates(embeddings: np.ndarray, threshold: float = DUPLICATE_THRESHOLD, chunk_size: int = 1024) -> np.ndarray:
+    """
+    Clusters near-duplicate embeddings with a blocked similarity self-join. The cosine similarities are
+    computed chunk by chunk as matrix products against all later rows, so memory stays at
+    chunk_size x n. Pairs above the threshold are merged with union-find (single linkage).
+
+    :param embeddings: An array of embeddings, one per row.
+    :type embeddings: numpy.ndarray
+    :param threshold: Cosine similarity at and above which two embeddings are near-duplicates. Defaults to 0.98.
+    :type threshold: float
+    :param chunk_size: Number of rows per block. Defaults to 1024.
+    :type chunk_size: int
+    :return: For every row, the index of its cluster representative (the lowest row index in the cluster).
+    :rtype: numpy.ndarray
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings = embeddings / np.where(norms > 0, norms, 1)
+    n = len(embeddings)
+
+    parent = np.arange(n)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        similarities = embeddings[start:end] @ embeddings[start:].T
+        # Keep only pairs (i, j) with j > i
+        similarities[np.tril_indices(end - start, m=n - start)] = -np.inf
+        rows, cols = np.nonzero(similarities >= threshold)
+        for i, j in zip(rows + start, cols + start):
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                # The lower index becomes the root, so it ends up as representative
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    return np.array([find(i) for i in range(n)])
@@ -0,0 +1,480 @@
+"""
+Offline quality-vs-latency evaluation for search algorithms.
+
+Labeled queries are built from the MusicCaps `aspect_list` column: each query is a
+combination of aspects taken from a seed track, and every track is graded by how many
+of the query aspects it carries. Any `SearchAlgorithm` subclass can be evaluated with
+recall@k, nDCG@k and MRR next to per-query latency and memory. The results are written
+as a JSON and a Markdown report, including the Pareto front of quality vs. latency.
+
+Run from the "src" directory, e.g.:
+    $ python evaluate_search.py --embedder hashing
+    $ python evaluate_search.py --embedder cache --populate-cache
+    $ python evaluate_search.py --clusters embeddings/duplicate_clusters.npy
+"""
+
+import argparse
+import ast
+import importlib
+import json
+import os
+import random
+import re
+import sys
+import time
+import tracemalloc
+import zlib
+from collections import Counter, defaultdict
+from typing import Dict, List, Set, Callable
+
+import numpy as np
+import pandas as pd
+
+from rate_limit import Priority
+from search import SearchAlgorithm, get_openai_embedding
+from snapshot import load_clusters
+
+CSV_PATH = "data/musiccaps-public.csv"
+EMBEDDINGS_PATH = "embeddings/aggregated_embeddings.npy"
+QUERY_CACHE_PATH = "embeddings/query_embeddings.npz"
+
+
+################
+## EMBEDDINGS ##
+################
+
+class HashingEmbedder:
+
+    def __init__(self, dim: int = 512):
+        """
+        Initializes a local bag-of-words embedder based on the hashing trick. It needs no API access,
+        so catalog and queries can both be embedded offline. Its absolute quality is lower than that of
+        the OpenAI embeddings, but it is consistent, which is all that is needed to compare search algorithms.
+
+        :param dim: The dimensionality of the embeddings. Defaults to 512.
+        :type dim: int
+        """
+        self.dim = dim
+
+    def __call__(self, text: str) -> np.ndarray:
+        """
+        Embeds a text as an L2-normalized vector of signed, hashed unigram and bigram counts.
+
+        :param text: The text to embed.
+        :type text: str
+        :return: The embedding of the text.
+        :rtype: numpy.ndarray
+        """
+        tokens = re.findall(r"[a-z0-9]+", text.lower())
+        features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+        embedding = np.zeros(self.dim, dtype=np.float32)
+        for feature in features:
+            h = zlib.crc32(feature.encode("utf-8"))
+            embedding[h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm > 0 else embedding
+
+    def embed_many(self, texts: List[str]) -> np.ndarray:
+        """
+        Embeds a list of texts.
+
+        :param texts: The texts to embed.
+        :type texts: List[str]
+        :return: A matrix with one embedding per row.
+        :rtype: numpy.ndarray
+        """
+        return np.stack([self(text) for text in texts])
+
+
+class QueryEmbeddingCache:
+
+    def __init__(self, path: str, fallback: Callable[[str], np.ndarray] = None):
+        """
+        Initializes a file-backed cache of query embeddings.
+
+        :param path: Path of the .npz cache file. It is created on save if it does not exist.
+        :type path: str
+        :param fallback: Function used to embed queries missing from the cache, e.g. the OpenAI API.
+            If None, the cache is strictly offline and missing queries raise a KeyError.
+        :type fallback: Callable[[str], numpy.ndarray]
+        """
+        self.path = path
+        self.fallback = fallback
+        self.embeddings = {}
+        self.dirty = False
+        if os.path.exists(path):
+            data = np.load(path, allow_pickle=False)
+            for text, embedding in zip(data["texts"], data["embeddings"]):
+                self.embeddings[str(text)] = embedding
+
+    def __call__(self, text: str) -> np.ndarray:
+        """
+        Returns the cached embedding of a text, computing it with the fallback if needed.
+
+        :param text: The text to embed.
+        :type text: str
+        :return: The embedding of the text.
+        :rtype: numpy.ndarray
+        """
+        if text not in self.embeddings:
+            if self.fallback is None:
+                raise KeyError(f"No cached embedding for query '{text}'. Run with --populate-cache once while online.")
+            self.embeddings[text] = np.asarray(self.fallback(text), dtype=np.float32)
+            self.dirty = True
+        return self.embeddings[text]
+
+    def save(self) -> None:
+        """
+        Writes the cache to disk if new embeddings were added.
+        """
+        if not self.dirty:
+            return
+        texts = list(self.embeddings)
+        np.savez(self.path, texts=np.array(texts), embeddings=np.stack([self.embeddings[t] for t in texts]))
+        self.dirty = False
+
+
+#############
+## QUERIES ##
+#############
+
+class LabeledQuery:
+
+    def __init__(self, text: str, aspects: List[str], gains: Dict[int, int]):
+        """
+        Initializes a labeled query.
+
+        :param text: The query text passed to the search algorithm.
+        :type text: str
+        :param aspects: The aspects the query is made of.
+        :type aspects: List[str]
+        :param gains: Graded relevance per track index, i.e. the number of query aspects the track carries.
+        :type gains: Dict[int, int]
+        """
+        self.text = text
+        self.aspects = aspects
+        self.gains = gains
+        # A track is fully relevant if it carries all query aspects
+        self.relevant = {i for i, gain in gains.items() if gain == len(aspects)}
+
+
+def parse_aspect_lists(df: pd.DataFrame) -> List[List[str]]:
+    """
+    Parses the `aspect_list` column of a MusicCaps data frame into normalized lists of aspects.
+
+    :param df: A data frame with an `aspect_list` column of stringified Python lists.
+    :type df: pandas.DataFrame
+    :return: One list of lowercase aspects per track.
+    :rtype: List[List[str]]
+    """
+    aspect_lists = []
+    for raw in df["aspect_list"].tolist():
+        try:
+            aspects = ast.literal_eval(raw)
+        except (ValueError, SyntaxError):
+            aspects = []
+        aspect_lists.append(sorted({a.strip().lower() for a in aspects if a.strip()}))
+    return aspect_lists
+
+
+def build_queries(aspect_lists: List[List[str]], n_queries: int = 200, n_aspects: int = 2,
+                  min_support: int = 5, seed: int = 0) -> List[LabeledQuery]:
+    """
+    Builds labeled queries by combining aspects of randomly drawn seed tracks.
+
+    :param aspect_lists: One list of aspects per track.
+    :type aspect_lists: List[List[str]]
+    :param n_queries: The number of queries to build. Defaults to 200.
+    :type n_queries: int
+    :param n_aspects: The number of aspects per query. Defaults to 2.
+    :type n_aspects: int
+    :param min_support: Only aspects carried by at least this many tracks are used. Defaults to 5.
+    :type min_support: int
+    :param seed: Seed of the random number generator. Defaults to 0.
+    :type seed: int
+    :return: A list of unique labeled queries.
+    :rtype: List[LabeledQuery]
+    """
+    postings = defaultdict(set)
+    for i, aspects in enumerate(aspect_lists):
+        for aspect in aspects:
+            postings[aspect].add(i)
+
+    rng = random.Random(seed)
+    candidates = list(range(len(aspect_lists)))
+    rng.shuffle(candidates)
+
+    queries, seen = [], set()
+    for i in candidates:
+        if len(queries) >= n_queries:
+            break
+        frequent = [a for a in aspect_lists[i] if len(postings[a]) >= min_support]
+        if len(frequent) < n_aspects:
+            continue
+        aspects = sorted(rng.sample(frequent, n_aspects))
+        text = ", ".join(aspects)
+        if text in seen:
+            continue
+        seen.add(text)
+        gains = Counter()
+        for aspect in aspects:
+            gains.update(postings[aspect])
+        queries.append(LabeledQuery(text=text, aspects=aspects, gains=dict(gains)))
+    return queries
+
+
+def collapse_queries(queries: List[LabeledQuery], clusters: np.ndarray) -> List[LabeledQuery]:
+    """
+    Maps labeled queries onto a deduplicated index that keeps one representative per near-duplicate
+    cluster. Track indices become positions in the deduplicated index, and a representative gets the
+    highest gain of its cluster members.
+
+    :param queries: Labeled queries over the full catalog.
+    :type queries: List[LabeledQuery]
+    :param clusters: The representative row of every row of the full catalog.
+    :type clusters: numpy.ndarray
+    :return: Labeled queries over the deduplicated index.
+    :rtype: List[LabeledQuery]
+    """
+    position = {int(row): i for i, row in enumerate(np.unique(clusters))}
+    collapsed = []
+    for query in queries:
+        gains = {}
+        for i, gain in query.gains.items():
+            p = position[int(clusters[i])]
+            gains[p] = max(gains.get(p, 0), gain)
+        collapsed.append(LabeledQuery(text=query.text, aspects=query.aspects, gains=gains))
+    return collapsed
+
+
+#############
+## METRICS ##
+#############
+
+def recall_at_k(ranked: List[int], relevant: Set[int], k: int) -> float:
+    """
+    Returns the fraction of relevant tracks found in the top k results.
+    """
+    if not relevant:
+        return 0.0
+    return len(relevant.intersection(ranked[:k])) / len(relevant)
+
+
+def ndcg_at_k(ranked: List[int], gains: Dict[int, int], k: int) -> float:
+    """
+    Returns the normalized discounted cumulative gain of the top k results.
+    """
+    discounts = 1.0 / np.log2(np.arange(2, k + 2))
+    dcg = sum(gains.get(i, 0) * d for i, d in zip(ranked[:k], discounts))
+    ideal = sorted(gains.values(), reverse=True)[:k]
+    idcg = sum(g * d for g, d in zip(ideal, discounts))
+    return dcg / idcg if idcg > 0 else 0.0
+
+
+def reciprocal_rank(ranked: List[int], relevant: Set[int]) -> float:
+    """
+    Returns the reciprocal rank of the first relevant result, or 0 if none was retrieved.
+    """
+    for rank, i in enumerate(ranked, start=1):
+        if i in relevant:
+            return 1.0 / rank
+    return 0.0
+
+
+def index_memory(search_algo: SearchAlgorithm) -> int:
+    """
+    Returns the number of bytes held in numpy arrays by a search algorithm.
+    """
+    return sum(value.nbytes for value in vars(search_algo).values() if isinstance(value, np.ndarray))
+
+
+################
+## EVALUATION ##
+################
+
+def evaluate(search_algo: SearchAlgorithm, queries: List[LabeledQuery], k_values: List[int]) -> dict:
+    """
+    Runs all queries through a search algorithm and measures quality, latency and memory.
+
+    Latency is measured in a first pass and memory in a second pass under tracemalloc, so that
+    the tracing overhead does not distort the timings. Query embeddings should be cached or local,
+    so that only the search itself is measured.
+
+    :param search_algo: A search algorithm whose database has been read.
+    :type search_algo: SearchAlgorithm
+    :param queries: The labeled queries.
+    :type queries: List[LabeledQuery]
+    :param k_values: The cutoffs at which recall and nDCG are computed.
+    :type k_values: List[int]
+    :return: A dictionary with a summary and per-query results.
+    :rtype: dict
+    """
+    if not queries:
+        raise ValueError("No queries to evaluate.")
+    depth = max(k_values)
+    per_query = []
+    for query in queries:
+        start = time.perf_counter()
+        indices, _, _ = search_algo.find_similar(query.text, n=depth)
+        latency_ms = (time.perf_counter() - start) * 1000
+        ranked = [int(i) for i in indices]
+        row = {"query": query.text, "n_relevant": len(query.relevant), "latency_ms": latency_ms,
+               "mrr": reciprocal_rank(ranked, query.relevant)}
+        for k in k_values:
+            row[f"recall@{k}"] = recall_at_k(ranked, query.relevant, k)
+            row[f"ndcg@{k}"] = ndcg_at_k(ranked, query.gains, k)
+        per_query.append(row)
+
+    tracemalloc.start()
+    try:
+        for query, row in zip(queries, per_query):
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            search_algo.find_similar(query.text, n=depth)
+            row["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+    latencies = np.array([row["latency_ms"] for row in per_query])
+    summary = {
+        "algorithm": type(search_algo).__name__,
+        "n_queries": len(per_query),
+        "latency_p50_ms": float(np.percentile(latencies, 50)),
+        "latency_p95_ms": float(np.percentile(latencies, 95)),
+        "latency_p99_ms": float(np.percentile(latencies, 99)),
+        "peak_query_memory_bytes": int(max(row["peak_memory_bytes"] for row in per_query)),
+        "index_memory_bytes": index_memory(search_algo),
+        "mrr": float(np.mean([row["mrr"] for row in per_query])),
+    }
+    for k in k_values:
+        summary[f"recall@{k}"] = float(np.mean([row[f"recall@{k}"] for row in per_query]))
+        summary[f"ndcg@{k}"] = float(np.mean([row[f"ndcg@{k}"] for row in per_query]))
+    return {"summary": summary, "queries": per_query}
+
+
+def pareto_front(summaries: List[dict], quality_key: str, latency_key: str = "latency_p95_ms") -> List[str]:
+    """
+    Returns the names of the algorithms that are not dominated in quality (higher is better)
+    and latency (lower is better).
+    """
+    front = []
+    for a in summaries:
+        dominated = any(
+            b[quality_key] >= a[quality_key] and b[latency_key] <= a[latency_key]
+            and (b[quality_key] > a[quality_key] or b[latency_key] < a[latency_key])
+            for b in summaries
+        )
+        if not dominated:
+            front.append(a["algorithm"])
+    return front
+
+
+def write_report(results: List[dict], quality_key: str, output_dir: str) -> None:
+    """
+    Writes the evaluation results as JSON and as a Markdown table marking the Pareto front.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    summaries = [result["summary"] for result in results]
+    front = pareto_front(summaries, quality_key)
+
+    with open(os.path.join(output_dir, "search_evaluation.json"), "w") as f:
+        json.dump({"quality_key": quality_key, "pareto_front": front, "results": results}, f, indent=2)
+
+    metric_keys = [key for key in summaries[0] if key.startswith(("recall@", "ndcg@"))] + ["mrr"]
+    header = ["algorithm", "pareto"] + metric_keys + ["p50 ms", "p95 ms", "p99 ms", "index MB", "peak query MB"]
+    lines = ["| " + " | ".join(header) + " |", "|" + "---|" * len(header)]
+    for s in summaries:
+        cells = [s["algorithm"], "*" if s["algorithm"] in front else ""]
+        cells += [f"{s[key]:.4f}" for key in metric_keys]
+        cells += [f"{s['latency_p50_ms']:.2f}", f"{s['latency_p95_ms']:.2f}", f"{s['latency_p99_ms']:.2f}",
+                  f"{s['index_memory_bytes'] / 1e6:.1f}", f"{s['peak_query_memory_bytes'] / 1e6:.1f}"]
+        lines.append("| " + " | ".join(cells) + " |")
+    with open(os.path.join(output_dir, "search_evaluation.md"), "w") as f:
+        f.write(f"# Search Evaluation\n\nQuality: {quality_key}, latency: p95. Pareto-optimal algorithms are marked with *.\n\n")
+        f.write("\n".join(lines) + "\n")
+
+
+def load_algorithm(spec: str) -> SearchAlgorithm:
+    """
+    Instantiates a search algorithm from a "module:ClassName" specification.
+    """
+    module_name, class_name = spec.split(":")
+    cls = getattr(importlib.import_module(module_name), class_name)
+    if not issubclass(cls, SearchAlgorithm):
+        raise TypeError(f"{spec} is not a SearchAlgorithm subclass.")
+    return cls()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Evaluate search algorithms on MusicCaps aspect queries.")
+    parser.add_argument("--algorithms", nargs="+", default=["search:SimpleCosineSimilarity"],
+                        help="Search algorithms to evaluate as module:ClassName.")
+    parser.add_argument("--embedder", choices=["cache", "hashing"], default="cache",
+                        help="'cache' uses the aggregated OpenAI embeddings and cached query embeddings, "
+                             "'hashing' embeds catalog and queries locally.")
+    parser.add_argument("--query-cache", default=QUERY_CACHE_PATH)
+    parser.add_argument("--populate-cache", action="store_true",
+                        help="Fetch query embeddings missing from the cache from the OpenAI API.")
+    parser.add_argument("--n-queries", type=int, default=200)
+    parser.add_argument("--n-aspects", type=int, default=2)
+    parser.add_argument("--min-support", type=int, default=5)
+    parser.add_argument("--k", type=int, nargs="+", default=[5, 10, 50])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--clusters", default=None,
+                        help="Near-duplicate cluster mapping. If given, every algorithm is also evaluated "
+                             "on the deduplicated index.")
+    parser.add_argument("--output-dir", default="evaluation")
+    args = parser.parse_args()
+
+    # Build labeled queries
+    df = pd.read_csv(CSV_PATH, usecols=["ytid", "caption", "aspect_list"])
+    queries = build_queries(parse_aspect_lists(df), n_queries=args.n_queries, n_aspects=args.n_aspects,
+                            min_support=args.min_support, seed=args.seed)
+    print(f"Built {len(queries)} labeled queries.")
+    if not queries:
+        sys.exit(f"No track has {args.n_aspects} aspects carried by at least {args.min_support} tracks each. "
+                 "Lower --n-aspects or --min-support.")
+
+    # Prepare catalog and query embeddings
+    if args.embedder == "hashing":
+        embedder = HashingEmbedder()
+        embeddings = embedder.embed_many(df["caption"].tolist())
+    else:
+        fallback = (lambda text: get_openai_embedding(text, priority=Priority.BULK)) if args.populate_cache else None
+        embedder = QueryEmbeddingCache(args.query_cache, fallback=fallback)
+        embeddings = np.load(EMBEDDINGS_PATH)
+    try:
+        query_embeddings = {query.text: embedder(query.text) for query in queries}
+    finally:
+        if isinstance(embedder, QueryEmbeddingCache):
+            embedder.save()
+
+    # Full catalog and, optionally, the deduplicated index
+    captions, track_names = df["caption"].tolist(), df["ytid"].tolist()
+    variants = [("", embeddings, captions, track_names, queries)]
+    if args.clusters:
+        clusters = load_clusters(args.clusters, len(df))
+        row_ids = np.unique(clusters)
+        variants.append((" (deduplicated)", embeddings[row_ids], [captions[i] for i in row_ids],
+                         [track_names[i] for i in row_ids], collapse_queries(queries, clusters)))
+
+    # Evaluate
+    results = []
+    for spec in args.algorithms:
+        for suffix, variant_embeddings, variant_captions, variant_names, variant_queries in variants:
+            search_algo = load_algorithm(spec)
+            search_algo.embedding_function = query_embeddings.__getitem__
+            search_algo.read_database(
+                embeddings=variant_embeddings,
+                captions=variant_captions,
+                track_names=variant_names
+            )
+            result = evaluate(search_algo, variant_queries, args.k)
+            result["summary"]["algorithm"] = spec + suffix
+            results.append(result)
+            print(f"Evaluated {spec + suffix}.")
+
+    quality_key = f"ndcg@{min(args.k)}"
+    write_report(results, quality_key, args.output_dir)
+    print(f"Report written to {args.output_dir}/.")
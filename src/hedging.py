@@ -0,0 +1,171 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, CancelledError, ThreadPoolExecutor, wait
+from typing import Any, Callable
+
+import numpy as np
+
+from rate_limit import TokenBucket
+
+
+class Hedger:
+
+    def __init__(self, percentile: float = 95, window: int = 200, min_samples: int = 20,
+                 initial_deadline: float = 10.0, min_deadline: float = 0.5, max_deadline: float = 30.0,
+                 max_hedge_rate: float = 0.1, max_hedge_tokens_per_minute: float = 20000, max_workers: int = 16):
+        """
+        Initializes a hedger. A hedged call issues a duplicate request if the first one has not returned
+        within an adaptive deadline, the given percentile of recently observed latencies. The first response
+        wins and the other request is cancelled if it has not been sent yet.
+
+        :param percentile: Percentile of recent latencies used as the hedging deadline. Defaults to 95.
+        :type percentile: float
+        :param window: Number of recent calls used for latencies and the hedge rate. Defaults to 200.
+        :type window: int
+        :param min_samples: Number of latencies needed before the deadline adapts. Defaults to 20.
+        :type min_samples: int
+        :param initial_deadline: Deadline in seconds until enough latencies are known. Defaults to 10.
+        :type initial_deadline: float
+        :param min_deadline: Lower bound of the deadline in seconds. Defaults to 0.5.
+        :type min_deadline: float
+        :param max_deadline: Upper bound of the deadline in seconds. Defaults to 30.
+        :type max_deadline: float
+        :param max_hedge_rate: Maximum fraction of recent calls that may be hedged. Defaults to 0.1.
+        :type max_hedge_rate: float
+        :param max_hedge_tokens_per_minute: Budget of estimated tokens spent on duplicates per minute. Defaults to 20000.
+        :type max_hedge_tokens_per_minute: float
+        :param max_workers: Maximum number of concurrent requests, duplicates included. Further calls wait
+            for a free worker. Defaults to 16.
+        :type max_workers: int
+        """
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.initial_deadline = initial_deadline
+        self.min_deadline = min_deadline
+        self.max_deadline = max_deadline
+        self.max_hedge_rate = max_hedge_rate
+        self.hedge_tokens = TokenBucket(max_hedge_tokens_per_minute)
+        self.latencies = deque(maxlen=window)
+        self.recent_hedges = deque(maxlen=window)
+        self.counters = {"calls": 0, "hedges": 0, "hedge_wins": 0, "skipped_rate_guard": 0,
+                         "skipped_cost_guard": 0, "skipped_not_allowed": 0, "cancelled": 0}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedger")
+
+    def deadline(self) -> float:
+        """
+        Returns the current hedging deadline in seconds.
+
+        :return: The deadline.
+        :rtype: float
+        """
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return self.initial_deadline
+            deadline = float(np.percentile(self.latencies, self.percentile))
+        return min(self.max_deadline, max(self.min_deadline, deadline))
+
+    def _submit(self, fn: Callable[[threading.Event], Any]):
+        """
+        Submits a request with its own cancel event and records its latency when it succeeds.
+        """
+        start = time.monotonic()
+        cancelled = threading.Event()
+        future = self._executor.submit(fn, cancelled)
+
+        def record(f):
+            if f.cancelled() or isinstance(f.exception(), CancelledError):
+                with self._lock:
+                    self.counters["cancelled"] += 1
+            elif f.exception() is None:
+                with self._lock:
+                    self.latencies.append(time.monotonic() - start)
+
+        future.add_done_callback(record)
+        return future, cancelled
+
+    def _may_hedge(self, estimated_tokens: int, allow_hedge: Callable[[], bool]) -> bool:
+        """
+        Checks the guards that limit the extra spend of hedging and books the hedge if they pass.
+        """
+        if allow_hedge is not None and not allow_hedge():
+            with self._lock:
+                self.counters["skipped_not_allowed"] += 1
+            return False
+        with self._lock:
+            if (sum(self.recent_hedges) + 1) / (len(self.recent_hedges) + 1) > self.max_hedge_rate:
+                self.counters["skipped_rate_guard"] += 1
+                return False
+            self.hedge_tokens.refill(time.monotonic())
+            if self.hedge_tokens.level < estimated_tokens:
+                self.counters["skipped_cost_guard"] += 1
+                return False
+            self.hedge_tokens.take(estimated_tokens)
+            self.counters["hedges"] += 1
+            return True
+
+    def call(self, fn: Callable[[threading.Event], Any], estimated_tokens: int = 0, allow_hedge: Callable[[], bool] = None) -> Any:
+        """
+        Runs a request, hedging it with a duplicate if it exceeds the deadline and the guards allow it.
+
+        When one request succeeds, the cancel event of the other one is set. The function must check it
+        before sending its request and raise a CancelledError if it is set, e.g. while it waits for rate
+        limit budget. Requests already in flight cannot be aborted; the losing response is discarded
+        when it arrives, so they should have a timeout.
+
+        :param fn: A function making the request, called with a cancel event. It must be safe to call twice.
+        :type fn: Callable[[threading.Event], Any]
+        :param estimated_tokens: Estimated tokens of one request, charged to the hedge token budget. Defaults to 0.
+        :type estimated_tokens: int
+        :param allow_hedge: Optional function that can veto a hedge, e.g. while the rate limit is congested.
+        :type allow_hedge: Callable[[], bool]
+        :return: The first successful response.
+        :rtype: Any
+        """
+        with self._lock:
+            self.counters["calls"] += 1
+
+        primary, primary_cancelled = self._submit(fn)
+        done, _ = wait([primary], timeout=self.deadline())
+        hedged = not done and self._may_hedge(estimated_tokens, allow_hedge)
+        with self._lock:
+            self.recent_hedges.append(hedged)
+        if not hedged:
+            return primary.result()
+
+        hedge, hedge_cancelled = self._submit(fn)
+        cancel_events = {primary: primary_cancelled, hedge: hedge_cancelled}
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        cancel_events[loser].set()
+                        loser.cancel()
+                    if future is hedge:
+                        with self._lock:
+                            self.counters["hedge_wins"] += 1
+                    return future.result()
+        # Both requests failed
+        return primary.result()
+
+    def metrics(self) -> dict:
+        """
+        Returns hedging metrics: counters, the hedge rate and the current deadline.
+
+        :return: A dictionary of metrics.
+        :rtype: dict
+        """
+        deadline = self.deadline()
+        with self._lock:
+            metrics = dict(self.counters)
+            metrics["hedge_rate"] = self.counters["hedges"] / max(self.counters["calls"], 1)
+            metrics["recent_hedge_rate"] = sum(self.recent_hedges) / max(len(self.recent_hedges), 1)
+            metrics["deadline_s"] = deadline
+            metrics["hedge_tokens_available"] = self.hedge_tokens.level
+            if self.latencies:
+                metrics["latency_p50_s"] = float(np.percentile(self.latencies, 50))
+                metrics["latency_p99_s"] = float(np.percentile(self.latencies, 99))
+        return metrics
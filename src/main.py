@@ -1,40 +1,39 @@
-import openai
-import os
-import sys
-import numpy as np
-import pandas as pd
+import argparse
 
+from catalogs import DEFAULT_CATALOG
 from chat_bot import HardCodedBouncerBot, ReceptionChatBot, ReceptionSummarizerBot, RecommenderChatBot
-from search import SimpleCosineSimilarity
-
-# Read openai api key from environment variable
-openai.api_key = os.getenv("OPENAI_API_KEY")
+from startup import get_search_algo, timer, warm_up
 
 N_RSEARCH_RESULTS = 5
+N_CANDIDATES = 500 # Candidates kept for re-ranking when the user refines their request
+HEDGE_REQUESTS = False # Issue duplicate API requests when a call is slower than usual
 
 if __name__ == "__main__":
 
 
+    parser = argparse.ArgumentParser(description="Music Search Chatbot")
+    parser.add_argument("--catalog", default=DEFAULT_CATALOG, help="Name of the catalog to search (see catalogs.py).")
+    parser.add_argument("--startup-report", action="store_true", help="Print a startup timing report.")
+    args = parser.parse_args()
+
+
     #################
     ## PREPARATION ##
     #################
     
-    # Read data & embeddings
-    df = pd.read_csv("data/musiccaps-public.csv")
-    embeddings = np.load("embeddings/aggregated_embeddings.npy")
-    
-    # Instantiate search algo
-    search_algo = SimpleCosineSimilarity()
-    search_algo.read_database(
-        embeddings=embeddings,
-        captions=df["caption"].tolist(),
-        track_names=df["ytid"].tolist()
-    )
+    # Load search database in the background while the user talks to the receptionist
+    warm_up_thread = warm_up(catalog=args.catalog, hedge=HEDGE_REQUESTS)
     
     # Instantiate chat bots
-    receptionist = ReceptionChatBot()
-    bouncer = HardCodedBouncerBot(stop_phrases=["start search"])
-    summarizer = ReceptionSummarizerBot()
+    with timer.measure("instantiate bots"):
+        receptionist = ReceptionChatBot(hedge=HEDGE_REQUESTS)
+        bouncer = HardCodedBouncerBot(stop_phrases=["start search"])
+        refiner = HardCodedBouncerBot(stop_phrases=["refine search"])
+        summarizer = ReceptionSummarizerBot(hedge=HEDGE_REQUESTS)
+    
+    if args.startup_report:
+        warm_up_thread.join()
+        print(timer.report())
     
     
     ##################
@@ -75,8 +74,10 @@ if __name__ == "__main__":
         print("\nSummary:", summary)
         
         
-        # Do search
-        indices, names, captions = search_algo.find_similar(summary, n=N_RSEARCH_RESULTS)
+        # Do search, keeping a larger candidate pool for refinements
+        search_algo = get_search_algo(args.catalog, hedge=HEDGE_REQUESTS)
+        pool = search_algo.find_candidates(summary, pool_size=N_CANDIDATES)
+        indices, names, captions = pool.top(N_RSEARCH_RESULTS)
         print("Search done. Starting conversation with recommender.")
         
         
@@ -88,7 +89,8 @@ if __name__ == "__main__":
         recommender = RecommenderChatBot(
             names=names,
             descriptions=captions,
-            user_input=summary
+            user_input=summary,
+            hedge=HEDGE_REQUESTS
         )
         
         print(f"\nAssistant: {recommender.get_response()}\n")
@@ -96,7 +98,15 @@ if __name__ == "__main__":
         while True:
             
             # Get user msg
-            recommender.get_user_input()
+            user_input = recommender.get_user_input()
+            
+            # Re-rank candidate pool and refresh the search results only if the user asks for it
+            refiner.read_conversation(recommender.messages)
+            follow_up = refiner.remove_stop_phrases(user_input)
+            if refiner.is_job_done() and follow_up:
+                search_algo = get_search_algo(args.catalog, hedge=HEDGE_REQUESTS)
+                pool, (indices, names, captions) = search_algo.refine(pool, follow_up, n=N_RSEARCH_RESULTS)
+                recommender.update_results(names, captions)
             
             # Get response from chat bot
             print(f"\nAssistant: {recommender.get_response()}\n")
@@ -0,0 +1,164 @@
+import os
+import threading
+from typing import Any, Callable, List, Union
+
+from rate_limit import Priority, RateLimitScheduler
+
+HEDGE_MAX_WORKERS = int(os.getenv("HEDGE_MAX_WORKERS", "16")) # Concurrent hedged calls per model, duplicates included
+HEDGED_REQUEST_TIMEOUT = 60 # Seconds after which a hedged request is aborted, so that losing requests are bounded
+
+_openai = None
+_scheduler = None
+_hedgers = {}
+_hedgers_lock = threading.Lock()
+
+
+def get_openai():
+    """
+    Returns the openai module, importing it and setting the API key on first use. Importing openai
+    is deferred so that modules using it can be imported without paying its import cost at startup.
+
+    :return: The openai module.
+    """
+    global _openai
+    if _openai is None:
+        import openai
+        # Read OpenAI API key from environment variable
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+        _openai = openai
+    return _openai
+
+
+def get_scheduler() -> RateLimitScheduler:
+    """
+    Returns the rate limit scheduler shared by all OpenAI calls of this process.
+
+    :return: The scheduler.
+    :rtype: RateLimitScheduler
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = RateLimitScheduler()
+    return _scheduler
+
+
+def set_scheduler(scheduler: RateLimitScheduler) -> None:
+    """
+    Replaces the shared rate limit scheduler, e.g. to run a bulk job with a smaller budget.
+
+    :param scheduler: The new scheduler.
+    :type scheduler: RateLimitScheduler
+    """
+    global _scheduler
+    _scheduler = scheduler
+
+
+def get_hedger(model: str):
+    """
+    Returns the hedger of a model, creating it on first use. Each model has its own hedger,
+    so that deadlines adapt to the latency profile of each model.
+
+    :param model: The model.
+    :type model: str
+    :return: The hedger.
+    :rtype: Hedger
+    """
+    with _hedgers_lock:
+        if model not in _hedgers:
+            from hedging import Hedger
+            _hedgers[model] = Hedger(max_workers=HEDGE_MAX_WORKERS)
+        return _hedgers[model]
+
+
+def hedging_metrics() -> dict:
+    """
+    Returns the hedging metrics per model.
+
+    :return: A dictionary of metrics per model.
+    :rtype: dict
+    """
+    with _hedgers_lock:
+        hedgers = dict(_hedgers)
+    return {model: hedger.metrics() for model, hedger in hedgers.items()}
+
+
+def _run(model: str, priority: Priority, tokens: int, create: Callable[[], Any], hedge: bool) -> Any:
+    """
+    Runs an API call through the shared scheduler, hedged if requested. Hedges are skipped while
+    calls to the model are waiting for budget, since a duplicate would only queue behind them.
+    The losing request of a hedged call is cancelled if it has not been sent yet.
+    """
+    def call(cancelled=None):
+        return get_scheduler().run(model, priority, tokens, create, cancelled)
+
+    if not hedge:
+        return call()
+    return get_hedger(model).call(call, estimated_tokens=tokens,
+                                  allow_hedge=lambda: not get_scheduler().is_congested(model))
+
+
+def estimate_tokens(text: Union[str, List[str]]) -> int:
+    """
+    Roughly estimates the number of tokens of a text, assuming four characters per token.
+
+    :param text: A text or a list of texts.
+    :type text: Union[str, List[str]]
+    :return: The estimated number of tokens.
+    :rtype: int
+    """
+    if isinstance(text, list):
+        return sum(estimate_tokens(t) for t in text)
+    return len(text) // 4 + 1
+
+
+def chat_completion(priority: Priority = Priority.INTERACTIVE, hedge: bool = False, **kwargs) -> Any:
+    """
+    Creates a chat completion through the shared rate limit scheduler.
+
+    :param priority: The priority of the call. Defaults to Priority.INTERACTIVE.
+    :type priority: Priority
+    :param hedge: Whether to hedge the call against tail latency. Defaults to False.
+    :type hedge: bool
+    :param kwargs: Arguments passed to openai.ChatCompletion.create.
+    :return: The response.
+    """
+    if hedge:
+        # A duplicate may be sent later, after the caller has changed its messages
+        kwargs["messages"] = [dict(m) for m in kwargs["messages"]]
+        kwargs.setdefault("request_timeout", HEDGED_REQUEST_TIMEOUT)
+    tokens = sum(estimate_tokens(m["content"]) + 4 for m in kwargs["messages"]) + kwargs.get("max_tokens", 256)
+    return _run(kwargs["model"], priority, tokens, lambda: get_openai().ChatCompletion.create(**kwargs), hedge)
+
+
+def completion(priority: Priority = Priority.INTERACTIVE, hedge: bool = False, **kwargs) -> Any:
+    """
+    Creates a text completion through the shared rate limit scheduler.
+
+    :param priority: The priority of the call. Defaults to Priority.INTERACTIVE.
+    :type priority: Priority
+    :param hedge: Whether to hedge the call against tail latency. Defaults to False.
+    :type hedge: bool
+    :param kwargs: Arguments passed to openai.Completion.create.
+    :return: The response.
+    """
+    if hedge:
+        kwargs.setdefault("request_timeout", HEDGED_REQUEST_TIMEOUT)
+    tokens = estimate_tokens(kwargs["prompt"]) + kwargs.get("max_tokens", 16)
+    return _run(kwargs["model"], priority, tokens, lambda: get_openai().Completion.create(**kwargs), hedge)
+
+
+def embedding(priority: Priority = Priority.INTERACTIVE, hedge: bool = False, **kwargs) -> Any:
+    """
+    Creates an embedding through the shared rate limit scheduler.
+
+    :param priority: The priority of the call. Defaults to Priority.INTERACTIVE.
+    :type priority: Priority
+    :param hedge: Whether to hedge the call against tail latency. Defaults to False.
+    :type hedge: bool
+    :param kwargs: Arguments passed to openai.Embedding.create.
+    :return: The response.
+    """
+    if hedge:
+        kwargs.setdefault("request_timeout", HEDGED_REQUEST_TIMEOUT)
+    tokens = estimate_tokens(kwargs["input"])
+    return _run(kwargs["model"], priority, tokens, lambda: get_openai().Embedding.create(**kwargs), hedge)
@@ -0,0 +1,268 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import CancelledError
+from enum import IntEnum
+from typing import Any, Callable, Dict
+
+# Requests and tokens per minute per model. Adjust to the limits of your OpenAI account.
+DEFAULT_BUDGETS = {
+    "gpt-3.5-turbo": {"requests_per_minute": 3500, "tokens_per_minute": 90000},
+    "text-davinci-003": {"requests_per_minute": 3000, "tokens_per_minute": 250000},
+    "text-embedding-ada-002": {"requests_per_minute": 3000, "tokens_per_minute": 1000000},
+}
+FALLBACK_BUDGET = {"requests_per_minute": 60, "tokens_per_minute": 40000}
+CANCEL_POLL_INTERVAL = 0.1 # Seconds between checks of the cancel event of a waiting call
+
+
+class Priority(IntEnum):
+    """
+    Priorities of API calls. Lower values are admitted first.
+    """
+    INTERACTIVE = 0     # Receptionist, bouncer and recommender turns the user is waiting for
+    SUMMARIZATION = 1   # Summarizing the reception and embedding the summary for search
+    BULK = 2            # Embedding jobs over the whole database
+
+
+class TokenBucket:
+
+    def __init__(self, per_minute: float):
+        """
+        Initializes a token bucket that holds up to one minute of budget and refills continuously.
+
+        :param per_minute: The budget per minute.
+        :type per_minute: float
+        """
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        """
+        Adds the budget accrued since the last update.
+        """
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        Returns the number of seconds until `amount` can be taken, 0 if it can be taken now.
+        Amounts above the capacity are clamped to it, so they are admitted once the bucket is full.
+        """
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float) -> None:
+        """
+        Takes `amount` from the bucket. The level may become negative, which delays later requests.
+        """
+        self.level -= amount
+
+
+class RateLimitScheduler:
+
+    def __init__(self, budgets: Dict[str, Dict[str, float]] = None, max_retries: int = 5):
+        """
+        Initializes a scheduler that admits API calls according to per-model requests-per-minute and
+        tokens-per-minute budgets. Waiting calls are admitted in order of priority, then arrival, so
+        interactive turns overtake queued summarization and bulk calls. Priorities only apply within
+        one scheduler, that is within one process.
+
+        :param budgets: Budgets per model, as in DEFAULT_BUDGETS. Defaults to DEFAULT_BUDGETS.
+        :type budgets: Dict[str, Dict[str, float]]
+        :param max_retries: How often a call is requeued after a rate limit error. Defaults to 5.
+        :type max_retries: int
+        """
+        self.budgets = dict(DEFAULT_BUDGETS if budgets is None else budgets)
+        self.max_retries = max_retries
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+        self._models = {}
+
+    def _model(self, model: str) -> dict:
+        """
+        Returns the state of a model, creating it on first use. Must be called with the lock held.
+        """
+        if model not in self._models:
+            budget = self.budgets.get(model, FALLBACK_BUDGET)
+            self._models[model] = {
+                "requests": TokenBucket(budget["requests_per_minute"]),
+                "tokens": TokenBucket(budget["tokens_per_minute"]),
+                "queue": [],
+                "in_flight": 0,
+                "admitted": 0,
+                "cancelled": 0,
+                "rate_limited": 0,
+                "paused_until": 0.0,
+            }
+        return self._models[model]
+
+    def _acquire(self, model: str, priority: Priority, tokens: int, cancelled: threading.Event = None) -> None:
+        """
+        Blocks until the call is at the head of its model's queue and the budget allows it.
+        Raises a CancelledError and leaves the queue if the cancel event is set while waiting.
+        """
+        poll = None if cancelled is None else CANCEL_POLL_INTERVAL
+        with self._condition:
+            state = self._model(model)
+            ticket = (int(priority), next(self._sequence))
+            heapq.heappush(state["queue"], ticket)
+            try:
+                while True:
+                    if cancelled is not None and cancelled.is_set():
+                        raise CancelledError()
+                    now = time.monotonic()
+                    state["requests"].refill(now)
+                    state["tokens"].refill(now)
+                    if state["queue"][0] == ticket:
+                        wait = max(
+                            state["paused_until"] - now,
+                            state["requests"].wait_time(1),
+                            state["tokens"].wait_time(tokens)
+                        )
+                        if wait <= 0:
+                            heapq.heappop(state["queue"])
+                            state["requests"].take(1)
+                            state["tokens"].take(tokens)
+                            state["in_flight"] += 1
+                            state["admitted"] += 1
+                            return
+                        self._condition.wait(timeout=wait if poll is None else min(wait, poll))
+                    else:
+                        self._condition.wait(timeout=poll)
+            except BaseException:
+                if ticket in state["queue"]:
+                    state["queue"].remove(ticket)
+                    heapq.heapify(state["queue"])
+                raise
+            finally:
+                # The head of the queue changed or the caller gave up, wake up the other waiters
+                self._condition.notify_all()
+
+    def _release(self, model: str, estimated_tokens: int, used_tokens: int = None) -> None:
+        """
+        Marks a call as finished and corrects the token budget by the actual usage, if known.
+        """
+        with self._condition:
+            state = self._model(model)
+            state["in_flight"] -= 1
+            if used_tokens is not None:
+                state["tokens"].take(used_tokens - estimated_tokens)
+            self._condition.notify_all()
+
+    def _cancel(self, model: str, estimated_tokens: int) -> None:
+        """
+        Releases an admitted call that was cancelled before it was made and returns its budget.
+        """
+        with self._condition:
+            state = self._model(model)
+            state["in_flight"] -= 1
+            state["admitted"] -= 1
+            state["cancelled"] += 1
+            state["requests"].level = min(state["requests"].capacity, state["requests"].level + 1)
+            state["tokens"].level = min(state["tokens"].capacity, state["tokens"].level + estimated_tokens)
+            self._condition.notify_all()
+
+    def _rate_limited(self, model: str, retry_after: float) -> None:
+        """
+        Pauses a model after a rate limit error and empties its buckets.
+        """
+        with self._condition:
+            state = self._model(model)
+            state["rate_limited"] += 1
+            state["paused_until"] = max(state["paused_until"], time.monotonic() + retry_after)
+            state["requests"].level = min(state["requests"].level, 0.0)
+            state["tokens"].level = min(state["tokens"].level, 0.0)
+            self._condition.notify_all()
+
+    def run(self, model: str, priority: Priority, estimated_tokens: int, call: Callable[[], Any],
+            cancelled: threading.Event = None) -> Any:
+        """
+        Runs an API call once the budget of its model allows it. Calls that fail with a rate limit
+        error pause the model and are requeued with the same priority. If the cancel event is set
+        before the call is made, its budget is returned and a CancelledError is raised.
+
+        :param model: The model the call is made to.
+        :type model: str
+        :param priority: The priority of the call.
+        :type priority: Priority
+        :param estimated_tokens: The estimated number of prompt and completion tokens.
+        :type estimated_tokens: int
+        :param call: A function making the API call.
+        :type call: Callable[[], Any]
+        :param cancelled: Optional event that cancels the call, e.g. when a hedged duplicate has already won.
+        :type cancelled: threading.Event
+        :return: The response of the call.
+        :rtype: Any
+        """
+        from openai_api import get_openai
+
+        attempt = 0
+        while True:
+            self._acquire(model, priority, estimated_tokens, cancelled)
+            if cancelled is not None and cancelled.is_set():
+                self._cancel(model, estimated_tokens)
+                raise CancelledError()
+            try:
+                response = call()
+            except get_openai().error.RateLimitError as e:
+                self._release(model, estimated_tokens)
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                headers = e.headers or {}
+                retry_after = headers.get("retry-after")
+                self._rate_limited(model, float(retry_after) if retry_after else min(2 ** attempt, 60))
+                continue
+            except BaseException:
+                self._release(model, estimated_tokens)
+                raise
+            try:
+                used_tokens = response["usage"]["total_tokens"]
+            except (KeyError, TypeError):
+                used_tokens = None
+            self._release(model, estimated_tokens, used_tokens)
+            return response
+
+    def is_congested(self, model: str) -> bool:
+        """
+        Returns whether calls to a model are currently waiting for budget.
+
+        :param model: The model.
+        :type model: str
+        :return: True if calls are queued or the model is paused after a rate limit error.
+        :rtype: bool
+        """
+        with self._condition:
+            state = self._model(model)
+            return bool(state["queue"]) or state["paused_until"] > time.monotonic()
+
+    def metrics(self) -> Dict[str, dict]:
+        """
+        Returns live metrics per model: queue depth per priority, calls in flight, remaining budget
+        and counters of admitted, cancelled and rate-limited calls.
+
+        :return: A dictionary of metrics per model.
+        :rtype: Dict[str, dict]
+        """
+        with self._condition:
+            now = time.monotonic()
+            metrics = {}
+            for model, state in self._models.items():
+                state["requests"].refill(now)
+                state["tokens"].refill(now)
+                metrics[model] = {
+                    "queue_depth": {p.name.lower(): sum(1 for t in state["queue"] if t[0] == p) for p in Priority},
+                    "in_flight": state["in_flight"],
+                    "requests_available": state["requests"].level,
+                    "requests_per_minute": state["requests"].capacity,
+                    "tokens_available": state["tokens"].level,
+                    "tokens_per_minute": state["tokens"].capacity,
+                    "admitted": state["admitted"],
+                    "cancelled": state["cancelled"],
+                    "rate_limited": state["rate_limited"],
+                    "paused_for_s": max(0.0, state["paused_until"] - now),
+                }
+            return metrics
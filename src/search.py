@@ -1,10 +1,146 @@
+import threading
 from abc import ABC, abstractmethod
-from typing import Dict, Any, List, Tuple
+from functools import partial
+from typing import Dict, Any, List, Tuple, Callable
 import numpy as np
-import openai
-import os
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+from openai_api import embedding
+from rate_limit import Priority
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+
+def get_openai_embedding(input_text: str, priority: Priority = Priority.SUMMARIZATION, hedge: bool = False) -> np.ndarray:
+    """
+    Embeds a text with the OpenAI embedding API.
+
+    Args:
+        input_text (str): The text to embed.
+        priority (Priority, optional): The priority of the API call. Defaults to Priority.SUMMARIZATION,
+            since search queries are embedded in the same hand-off stage as the summary.
+        hedge (bool, optional): Whether to hedge the API call against tail latency. Defaults to False.
+
+    Returns:
+        numpy.ndarray: The embedding of the input text.
+    """
+    response = embedding(
+        priority=priority,
+        hedge=hedge,
+        input=input_text,
+        model=EMBEDDING_MODEL
+        )
+    return np.array(response["data"][0]["embedding"])
+
+
+#####################
+## CANDIDATE POOLS ##
+#####################
+
+class CandidatePool:
+
+    def __init__(self, indices: np.ndarray, scores: np.ndarray, embeddings: np.ndarray, track_names: List[str],
+                 captions: List[str], query_text: str = "", constraint_weight: float = 0.5,
+                 query_embedding: np.ndarray = None, outside_query_score: float = 1.0):
+        """
+        Initializes a pool of scored search candidates that can be re-ranked locally when the user refines their request.
+
+        Args:
+            indices (numpy.ndarray): Database indices of the candidates, best first.
+            scores (numpy.ndarray): Cosine similarities of the candidates to the original query.
+            embeddings (numpy.ndarray): L2-normalized embeddings of the candidates, one per row.
+            track_names (List[str]): Track names of the candidates.
+            captions (List[str]): Captions of the candidates.
+            query_text (str, optional): The query the pool was searched with. Defaults to "".
+            constraint_weight (float, optional): Weight of the follow-up constraints in the combined score,
+                the original query has weight 1 - constraint_weight. Defaults to 0.5.
+            query_embedding (numpy.ndarray, optional): L2-normalized embedding of the query. Defaults to None.
+            outside_query_score (float, optional): Upper bound of the query scores of all tracks outside the pool,
+                -inf if the pool holds the whole database. Defaults to 1.0 (unknown).
+        """
+        self.indices = indices
+        self.query_scores = scores
+        self.embeddings = embeddings
+        self.track_names = track_names
+        self.captions = captions
+        self.query_text = query_text
+        self.query_embedding = query_embedding
+        self.outside_query_score = outside_query_score
+        self.follow_ups = []
+        self.constraint_weight = constraint_weight
+        self.constraint = None
+        self.constraint_scores = None
+        self.scores = scores
+
+    def add_constraint(self, constraint_embedding: np.ndarray) -> None:
+        """
+        Adds a follow-up constraint and re-scores all candidates with one matrix-vector product.
+        Constraints accumulate, so later follow-ups refine earlier ones instead of replacing them.
+
+        Args:
+            constraint_embedding (numpy.ndarray): Embedding of the follow-up constraint.
+
+        Returns:
+            None
+        """
+        constraint_embedding = np.asarray(constraint_embedding, dtype=np.float32)
+        constraint_embedding = constraint_embedding / np.linalg.norm(constraint_embedding)
+        self.set_constraint(constraint_embedding if self.constraint is None else self.constraint + constraint_embedding)
+
+    def set_constraint(self, constraint: np.ndarray) -> None:
+        """
+        Replaces the accumulated constraints and re-scores all candidates.
+
+        Args:
+            constraint (numpy.ndarray): The sum of the normalized embeddings of all constraints.
+
+        Returns:
+            None
+        """
+        self.constraint = constraint
+        self.constraint_scores = self.embeddings @ (self.constraint / np.linalg.norm(self.constraint))
+        self.scores = (1 - self.constraint_weight) * self.query_scores + self.constraint_weight * self.constraint_scores
+
+    def is_dry(self, n: int = 5) -> bool:
+        """
+        Returns whether the pool may miss some of the n best tracks of the whole database, in which case the
+        database has to be re-scored. Only the pool is used: a track outside the pool scores at most
+        (1 - w) * outside_query_score + w, since its constraint score is at most 1, so the n best candidates
+        are exact if the n-th best combined score of the pool reaches this bound.
+
+        Args:
+            n (int, optional): The number of results needed. Defaults to 5.
+
+        Returns:
+            bool: True if the pool has run dry.
+        """
+        if self.constraint is None:
+            return len(self.indices) < n
+        if len(self.scores) < n:
+            return self.outside_query_score > -np.inf
+        bound = (1 - self.constraint_weight) * self.outside_query_score + self.constraint_weight
+        return np.partition(self.scores, -n)[-n] < bound
+
+    def top(self, n: int = 5) -> Tuple[List[int], List[str], List[str]]:
+        """
+        Returns the n best candidates by their current score. Without constraints, the candidates are
+        returned in the order of the search.
+
+        Args:
+            n (int, optional): The number of results. Defaults to 5.
+
+        Returns:
+            Tuple[List[int], List[str], List[str]]: A tuple containing the indices, names, and captions of the n best candidates.
+        """
+        if self.constraint is None:
+            order = np.arange(min(n, len(self.indices)))
+        else:
+            order = np.argsort(-self.scores, kind="stable")[:n]
+        return (
+            [int(self.indices[i]) for i in order],
+            [self.track_names[i] for i in order],
+            [self.captions[i] for i in order]
+        )
+
 
 ##################
 ## SEARCH ALGOS ##
@@ -12,14 +148,40 @@ openai.api_key = os.getenv("OPENAI_API_KEY")
 
 class SearchAlgorithm(ABC):
  
-    def __init__(self):
+    def __init__(self, embedding_function: Callable[[str], np.ndarray] = None, hedge: bool = False):
         """
-        Initializes a new instance of the class. No parameters are required.
-        This method does not return anything.
+        Initializes a new instance of the class.
+
+        Args:
+            embedding_function (Callable[[str], numpy.ndarray], optional): Function used to embed search queries.
+                Defaults to the OpenAI embedding API. Pass a cached or local embedder to search offline.
+            hedge (bool, optional): Whether to hedge calls of the default embedding function against tail latency.
+                Defaults to False.
         """
-        ...
+        if embedding_function is None:
+            embedding_function = partial(get_openai_embedding, hedge=hedge)
+        self.embedding_function = embedding_function
+        self._last_query = threading.local()
+
+    def embed(self, input_text: str) -> np.ndarray:
+        """
+        Embeds a search query with the configured embedding function. The last query of each thread is
+        remembered, so that embedding the same query twice in a row calls the embedding function once.
+
+        Args:
+            input_text (str): The text to embed.
+
+        Returns:
+            numpy.ndarray: The embedding of the input text.
+        """
+        last_query = getattr(self._last_query, "value", None)
+        if last_query is not None and last_query[0] == input_text:
+            return last_query[1]
+        input_embedding = self.embedding_function(input_text)
+        self._last_query.value = (input_text, input_embedding)
+        return input_embedding
         
-    def read_database(self, embeddings: np.ndarray, captions: List[str], track_names: List[str]) -> None:
+    def read_database(self, embeddings: np.ndarray, captions: List[str], track_names: List[str], normalized: bool = False) -> None:
         """
         Reads a database and sets the attributes of the object with the given parameters.
 
@@ -27,6 +189,8 @@ class SearchAlgorithm(ABC):
             embeddings (numpy.ndarray): An array of embeddings.
             captions (List[str]): A list of captions for the embeddings.
             track_names (List[str]): A list of track names.
+            normalized (bool, optional): Whether the embeddings are already L2-normalized float32, e.g. when read
+                from a snapshot. The embeddings are stored as given either way. Defaults to False.
 
         Returns:
             None
@@ -34,6 +198,8 @@ class SearchAlgorithm(ABC):
         self.embeddings = embeddings
         self.track_names = track_names
         self.captions = captions
+        self.normalized = normalized
+        self._norms = None
 
     @abstractmethod
     def find_similar(self, input_text: str, n: int=5) -> List[str]:
@@ -50,9 +216,132 @@ class SearchAlgorithm(ABC):
         :rtype: List[str]
         """
         ...
+
+    def find_candidates(self, input_text: str, pool_size: int = 500) -> CandidatePool:
+        """
+        Finds a larger pool of candidates that follow-up refinements can re-rank without a new search.
+        By default, the pool holds the pool_size results of `find_similar` in their order, scored by the cosine
+        similarity of their embeddings to the query. Subclasses can override this method to score the whole
+        database at once.
+
+        :param input_text: a string representing the input text.
+        :type input_text: str
+
+        :param pool_size: the number of candidates to keep. Default is 500.
+        :type pool_size: int
+
+        :return: the candidate pool.
+        :rtype: CandidatePool
+        """
+        # Embedded before find_similar, which then reuses the embedding (see `embed`)
+        input_embedding = np.asarray(self.embed(input_text), dtype=np.float32)
+        indices, track_names, captions = self.find_similar(input_text, n=pool_size)
+        indices = np.asarray(indices)
+
+        embeddings = np.asarray(self.embeddings[indices], dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings / np.where(norms > 0, norms, 1)
+        input_embedding = input_embedding / np.linalg.norm(input_embedding)
+        return CandidatePool(
+            indices=indices,
+            scores=embeddings @ input_embedding,
+            embeddings=embeddings,
+            track_names=list(track_names),
+            captions=list(captions),
+            query_text=input_text,
+            query_embedding=input_embedding,
+            # find_similar may rank by something else than cosine similarity, so tracks outside are not bounded
+            outside_query_score=-np.inf if len(indices) >= len(self.embeddings) else 1.0
+        )
+
+    def _rescore_database(self, pool: CandidatePool) -> CandidatePool:
+        """
+        Re-scores the whole database with the query and constraint embeddings of a pool and returns a new pool
+        of the same size with the best tracks by combined score. This is one matrix-vector product with the
+        weighted sum of both embeddings and needs no embedding call.
+        """
+        w = pool.constraint_weight
+        direction = (1 - w) * pool.query_embedding + w * pool.constraint / np.linalg.norm(pool.constraint)
+        scores = self.embeddings @ direction.astype(self.embeddings.dtype)
+        if not getattr(self, "normalized", False):
+            if getattr(self, "_norms", None) is None or len(self._norms) != len(self.embeddings):
+                norms = np.linalg.norm(np.asarray(self.embeddings, dtype=np.float32), axis=1)
+                self._norms = np.where(norms > 0, norms, 1)
+            scores = scores / self._norms
+
+        pool_size = min(len(pool.indices), len(scores))
+        indices = np.argpartition(-scores, pool_size - 1)[:pool_size]
+        indices = indices[np.argsort(-scores[indices], kind="stable")]
+        candidates = np.asarray(self.embeddings[indices], dtype=np.float32)
+        if not getattr(self, "normalized", False):
+            candidates = candidates / self._norms[indices, None]
+
+        new_pool = CandidatePool(
+            indices=indices,
+            scores=candidates @ pool.query_embedding,
+            embeddings=candidates,
+            track_names=[self.track_names[i] for i in indices],
+            captions=[self.captions[i] for i in indices],
+            query_text=pool.query_text,
+            constraint_weight=w,
+            query_embedding=pool.query_embedding,
+            # Selected by combined score, so tracks outside may have higher query scores
+            outside_query_score=-np.inf if pool_size == len(scores) else 1.0
+        )
+        new_pool.follow_ups = list(pool.follow_ups)
+        new_pool.set_constraint(pool.constraint)
+        return new_pool
+
+    def refine(self, pool: CandidatePool, follow_up: str, n: int = 5) -> Tuple[CandidatePool, Tuple[List[int], List[str], List[str]]]:
+        """
+        Refines the results with a follow-up from the user. The candidate pool is re-ranked locally;
+        only if it may miss some of the n best tracks, the whole database is re-scored with the same
+        embeddings. Pools without a query embedding are searched again with the original query and all follow-ups.
+
+        :param pool: the candidate pool of the original search.
+        :type pool: CandidatePool
+
+        :param follow_up: the follow-up message of the user.
+        :type follow_up: str
+
+        :param n: the number of results. Default is 5.
+        :type n: int
+
+        :return: the candidate pool to use from now on, and the indices, names and captions of the n best results.
+        :rtype: Tuple[CandidatePool, Tuple[List[int], List[str], List[str]]]
+        """
+        pool.add_constraint(self.embed(follow_up))
+        pool.follow_ups.append(follow_up)
+        if pool.is_dry(n):
+            if pool.query_embedding is not None:
+                pool = self._rescore_database(pool)
+            else:
+                query_text = "\n".join([pool.query_text] + pool.follow_ups)
+                pool = self.find_candidates(query_text, pool_size=len(pool.indices))
+        return pool, pool.top(n)
         
         
 class SimpleCosineSimilarity(SearchAlgorithm):
+
+    def read_database(self, embeddings: np.ndarray, captions: List[str], track_names: List[str], normalized: bool = False) -> None:
+        """
+        Reads a database and L2-normalizes the embeddings once, so that a search is a single matrix-vector product.
+
+        Args:
+            embeddings (numpy.ndarray): An array of embeddings.
+            captions (List[str]): A list of captions for the embeddings.
+            track_names (List[str]): A list of track names.
+            normalized (bool, optional): Whether the embeddings are already L2-normalized float32, e.g. when read
+                from a snapshot. Defaults to False.
+
+        Returns:
+            None
+        """
+        if not normalized:
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings = embeddings / np.where(norms > 0, norms, 1)
+        super().read_database(embeddings=embeddings, captions=captions, track_names=track_names, normalized=True)
     
     def find_similar(self, input_text: str, n: int=5) -> Tuple[List[int], List[str], List[str]]:
         """
@@ -66,19 +355,47 @@ class SimpleCosineSimilarity(SearchAlgorithm):
             Tuple[List[int], List[str], List[str]]: A tuple containing the indices, names, and captions of the n most similar tracks.
         """
         
-        # Get embedding from openai api
-        response = openai.Embedding.create(
-            input=input_text,
-            model="text-embedding-ada-002"
-            )
-        
-        input_embedding = np.array(response["data"][0]["embedding"])
+        # Get embedding (from the openai api by default)
+        input_embedding = self.embed(input_text)
         
         # Compute cosine similarity
-        similarities = np.dot(self.embeddings, input_embedding) / (np.linalg.norm(self.embeddings, axis=1) * np.linalg.norm(input_embedding))
+        input_embedding = np.asarray(input_embedding, dtype=np.float32)
+        similarities = np.dot(self.embeddings, input_embedding) / np.linalg.norm(input_embedding)
         
         # Return most similar indices, captions, and names
         most_similar_indices = similarities.argsort()[-n:][::-1]
         most_similar_captions = [self.captions[i] for i in most_similar_indices]
         most_similar_names = [self.track_names[i] for i in most_similar_indices]
-        return most_similar_indices, most_similar_names, most_similar_captions
\ No newline at end of file
+        return most_similar_indices, most_similar_names, most_similar_captions
+
+    def find_candidates(self, input_text: str, pool_size: int = 500) -> CandidatePool:
+        """
+        Finds the pool_size most similar tracks to the given input text and keeps their scores and embeddings,
+        so that follow-up refinements can be re-ranked locally.
+
+        Args:
+            input_text (str): The text to compare with the track captions and names.
+            pool_size (int, optional): The number of candidates to keep. Defaults to 500.
+
+        Returns:
+            CandidatePool: The candidates, best first.
+        """
+        input_embedding = np.asarray(self.embed(input_text), dtype=np.float32)
+        input_embedding = input_embedding / np.linalg.norm(input_embedding)
+        similarities = np.dot(self.embeddings, input_embedding)
+
+        # Partial sort: only the pool is sorted, not the whole database
+        pool_size = min(pool_size, len(similarities))
+        pool = np.argpartition(-similarities, pool_size - 1)[:pool_size]
+        pool = pool[np.argsort(-similarities[pool], kind="stable")]
+        return CandidatePool(
+            indices=pool,
+            scores=similarities[pool],
+            embeddings=self.embeddings[pool],
+            track_names=[self.track_names[i] for i in pool],
+            captions=[self.captions[i] for i in pool],
+            query_text=input_text,
+            query_embedding=input_embedding,
+            # The database is sorted by query score, so no track outside scores higher than the last candidate
+            outside_query_score=float(similarities[pool[-1]]) if pool_size < len(similarities) else -np.inf
+        )
@@ -0,0 +1,209 @@
+"""
+Build step for the warm catalog snapshot.
+
+The snapshot is a single uncompressed .npz file holding the track names, the captions and the
+preprocessed search index (L2-normalized float32, one representative per near-duplicate cluster),
+so that a process can load its catalog with one read instead of parsing the CSV and normalizing
+the embedding matrix at every start. The paths, sizes and modification times of its sources are
+stored with it, so that an outdated snapshot is detected and not served.
+
+Run from the "src" directory after computing the embeddings. Without arguments, the snapshots of
+all registered catalogs (see catalogs.py) are built:
+    $ python snapshot.py [catalog ...]
+"""
+
+import json
+import os
+from typing import List, Tuple
+
+import numpy as np
+
+CSV_PATH = "data/musiccaps-public.csv"
+EMBEDDINGS_PATH = "embeddings/aggregated_embeddings.npy"
+CLUSTERS_PATH = "embeddings/duplicate_clusters.npy"
+SNAPSHOT_PATH = "embeddings/catalog_snapshot.npz"
+SNAPSHOT_VERSION = 3
+
+
+def _pack_strings(strings: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Packs a list of strings into a UTF-8 byte buffer and the character offsets of each string.
+    This is much more compact than a fixed-width unicode array for captions of varying length.
+    """
+    text = "".join(strings)
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in strings])
+    return np.frombuffer(text.encode("utf-8"), dtype=np.uint8), offsets
+
+
+def _unpack_strings(buffer: np.ndarray, offsets: np.ndarray) -> List[str]:
+    """
+    Unpacks strings packed by `_pack_strings`.
+    """
+    text = buffer.tobytes().decode("utf-8")
+    offsets = offsets.tolist()
+    return [text[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def source_fingerprint(csv_path: str = CSV_PATH, embeddings_path: str = EMBEDDINGS_PATH, clusters_path: str = CLUSTERS_PATH,
+                       name_column: str = "ytid", caption_column: str = "caption") -> str:
+    """
+    Describes the current state of the sources of a snapshot: the path, size and modification time
+    of every source file (None if it does not exist) and the columns read from the CSV.
+
+    :return: The description as a JSON string.
+    :rtype: str
+    """
+    files = {}
+    for role, path in (("csv", csv_path), ("embeddings", embeddings_path), ("clusters", clusters_path)):
+        if path and os.path.exists(path):
+            stat = os.stat(path)
+            files[role] = [path, stat.st_size, stat.st_mtime_ns]
+        else:
+            files[role] = None
+    return json.dumps({"files": files, "name_column": name_column, "caption_column": caption_column}, sort_keys=True)
+
+
+def load_clusters(clusters_path: str, n_rows: int) -> np.ndarray:
+    """
+    Loads a near-duplicate cluster mapping and checks that it was computed for a catalog of n_rows tracks.
+
+    :param clusters_path: Path of the cluster mapping, the representative row of every row.
+    :type clusters_path: str
+    :param n_rows: The number of rows of the catalog.
+    :type n_rows: int
+    :return: The cluster mapping.
+    :rtype: numpy.ndarray
+    """
+    clusters = np.load(clusters_path)
+    if len(clusters) != n_rows:
+        raise ValueError(f"Cluster mapping {clusters_path} has {len(clusters)} rows, but the catalog has {n_rows}. "
+                         "Re-run compute_embeddings.py or delete the mapping.")
+    return clusters
+
+
+def load_catalog(csv_path: str = CSV_PATH, embeddings_path: str = EMBEDDINGS_PATH, clusters_path: str = CLUSTERS_PATH,
+                 name_column: str = "ytid", caption_column: str = "caption") -> Tuple[np.ndarray, List[str], List[str], np.ndarray]:
+    """
+    Reads the catalog CSV and the aggregated embeddings. If a near-duplicate cluster mapping exists
+    (see embeddings/deduplicate.py), only one representative per cluster is kept.
+
+    :param csv_path: Path of the catalog CSV.
+    :type csv_path: str
+    :param embeddings_path: Path of the aggregated embeddings.
+    :type embeddings_path: str
+    :param clusters_path: Path of the cluster mapping, the representative row of every row.
+    :type clusters_path: str
+    :param name_column: Column with the unique track names. Defaults to "ytid".
+    :type name_column: str
+    :param caption_column: Column with the track captions. Defaults to "caption".
+    :type caption_column: str
+    :return: The embeddings, the captions, the track names and the CSV rows of the kept tracks.
+    :rtype: Tuple[numpy.ndarray, List[str], List[str], numpy.ndarray]
+    """
+    import pandas as pd
+
+    df = pd.read_csv(csv_path, usecols=[name_column, caption_column])
+    embeddings = np.load(embeddings_path)
+    if len(embeddings) != len(df):
+        raise ValueError(f"Embeddings {embeddings_path} have {len(embeddings)} rows, but {csv_path} has {len(df)}. "
+                         "Re-run compute_embeddings.py.")
+    if clusters_path and os.path.exists(clusters_path):
+        row_ids = np.unique(load_clusters(clusters_path, len(df)))
+    else:
+        row_ids = np.arange(len(df))
+
+    track_names = df[name_column].astype(str).to_numpy()[row_ids].tolist()
+    captions = df[caption_column].fillna("").astype(str).to_numpy()[row_ids].tolist()
+    return embeddings[row_ids], captions, track_names, row_ids
+
+
+def build_snapshot(csv_path: str = CSV_PATH, embeddings_path: str = EMBEDDINGS_PATH, clusters_path: str = CLUSTERS_PATH,
+                   snapshot_path: str = SNAPSHOT_PATH, name_column: str = "ytid", caption_column: str = "caption") -> None:
+    """
+    Reads the catalog with `load_catalog` and writes it as a warm snapshot.
+
+    :param csv_path: Path of the catalog CSV.
+    :type csv_path: str
+    :param embeddings_path: Path of the aggregated embeddings.
+    :type embeddings_path: str
+    :param clusters_path: Path of the near-duplicate cluster mapping. Ignored if it does not exist.
+    :type clusters_path: str
+    :param snapshot_path: Path the snapshot is written to.
+    :type snapshot_path: str
+    :param name_column: Column with the unique track names. Defaults to "ytid".
+    :type name_column: str
+    :param caption_column: Column with the track captions. Defaults to "caption".
+    :type caption_column: str
+    :return: None
+    """
+    embeddings, captions, track_names, _ = load_catalog(csv_path, embeddings_path, clusters_path,
+                                                        name_column, caption_column)
+    embeddings = embeddings.astype(np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings /= np.where(norms > 0, norms, 1)
+
+    sources = source_fingerprint(csv_path, embeddings_path, clusters_path, name_column, caption_column)
+    names, name_offsets = _pack_strings(track_names)
+    captions, caption_offsets = _pack_strings(captions)
+
+    np.savez(
+        snapshot_path,
+        version=np.array(SNAPSHOT_VERSION),
+        sources=np.array(sources),
+        embeddings=embeddings,
+        names=names,
+        name_offsets=name_offsets,
+        captions=captions,
+        caption_offsets=caption_offsets
+    )
+
+
+def is_snapshot_current(snapshot_path: str = SNAPSHOT_PATH, csv_path: str = CSV_PATH, embeddings_path: str = EMBEDDINGS_PATH,
+                        clusters_path: str = CLUSTERS_PATH, name_column: str = "ytid", caption_column: str = "caption") -> bool:
+    """
+    Returns whether a snapshot exists, has the current version and was built from the given sources in
+    their current state. Only the small header entries of the snapshot are read.
+
+    :param snapshot_path: Path of the snapshot.
+    :type snapshot_path: str
+    :return: True if the snapshot can be used instead of its sources.
+    :rtype: bool
+    """
+    if not os.path.exists(snapshot_path):
+        return False
+    with np.load(snapshot_path, allow_pickle=False) as data:
+        if "version" not in data or int(data["version"]) != SNAPSHOT_VERSION:
+            return False
+        return str(data["sources"]) == source_fingerprint(csv_path, embeddings_path, clusters_path,
+                                                          name_column, caption_column)
+
+
+def load_snapshot(snapshot_path: str = SNAPSHOT_PATH) -> Tuple[np.ndarray, List[str], List[str]]:
+    """
+    Loads a warm snapshot.
+
+    :param snapshot_path: Path of the snapshot.
+    :type snapshot_path: str
+    :return: The L2-normalized embeddings, the captions and the track names.
+    :rtype: Tuple[numpy.ndarray, List[str], List[str]]
+    """
+    with np.load(snapshot_path, allow_pickle=False) as data:
+        if int(data["version"]) != SNAPSHOT_VERSION:
+            raise ValueError(f"Snapshot {snapshot_path} has version {int(data['version'])}, expected {SNAPSHOT_VERSION}. Rebuild it.")
+        embeddings = data["embeddings"]
+        track_names = _unpack_strings(data["names"], data["name_offsets"])
+        captions = _unpack_strings(data["captions"], data["caption_offsets"])
+    return embeddings, captions, track_names
+
+
+if __name__ == "__main__":
+
+    import sys
+    from catalogs import load_registry
+
+    registry = load_registry()
+    for name in sys.argv[1:] or registry.names():
+        catalog = registry.catalog(name)
+        catalog.build_snapshot()
+        print(f"Snapshot of '{name}' written to {catalog.snapshot_path} ({os.path.getsize(catalog.snapshot_path) / 1e6:.1f} MB).")
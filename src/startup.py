@@ -0,0 +1,108 @@
+"""
+Lazy initialization of the search database and a startup timing report.
+
+The search database of a catalog is loaded on first use (or in the background via `warm_up`),
+preferably from the warm snapshot built by `snapshot.py`. Run this module to print a cold-start report:
+    $ python startup.py
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Tuple
+
+_PROCESS_START = time.perf_counter()
+
+
+class StartupTimer:
+
+    def __init__(self):
+        """
+        Initializes a timer that records the duration of named startup phases.
+        """
+        self.phases: List[Tuple[str, float]] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, name: str):
+        """
+        Context manager that records how long its body takes under the given phase name.
+
+        :param name: The name of the phase.
+        :type name: str
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases.append((name, time.perf_counter() - start))
+
+    def report(self) -> str:
+        """
+        Returns a human-readable report of all recorded phases and the time since process start.
+
+        :return: The report.
+        :rtype: str
+        """
+        with self._lock:
+            phases = list(self.phases)
+        width = max([len(name) for name, _ in phases] + [len("since import of startup")])
+        lines = ["Startup timing:"]
+        lines += [f"  {name:<{width}} {seconds * 1000:8.1f} ms" for name, seconds in phases]
+        lines.append(f"  {'since import of startup':<{width}} {(time.perf_counter() - _PROCESS_START) * 1000:8.1f} ms")
+        return "\n".join(lines)
+
+
+timer = StartupTimer()
+
+
+def get_search_algo(catalog: str = None, hedge: bool = False):
+    """
+    Returns the search algorithm of a catalog from the catalog registry (see catalogs.py), loading it on
+    first use. The warm snapshot is used if it exists; otherwise the CSV and the aggregated embeddings
+    are read, which is much slower.
+
+    :param catalog: The name of the catalog. Defaults to the default catalog.
+    :type catalog: str
+    :param hedge: Whether the search algorithm hedges its embedding calls. Only used when the catalog is loaded.
+    :type hedge: bool
+
+    :return: The search algorithm with its database read.
+    :rtype: SearchAlgorithm
+    """
+    from catalogs import DEFAULT_CATALOG, get_registry
+
+    return get_registry().get(catalog or DEFAULT_CATALOG, hedge=hedge)
+
+
+def warm_up(catalog: str = None, hedge: bool = False) -> threading.Thread:
+    """
+    Starts loading a catalog in a background thread, so that the process can respond
+    immediately and the database is ready by the time the first search runs.
+
+    :param catalog: The name of the catalog. Defaults to the default catalog.
+    :type catalog: str
+    :param hedge: Whether the search algorithm hedges its embedding calls.
+    :type hedge: bool
+
+    :return: The started daemon thread.
+    :rtype: threading.Thread
+    """
+    thread = threading.Thread(target=get_search_algo, args=(catalog, hedge), name="search-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+
+    with timer.measure("import chat_bot & search"):
+        import chat_bot  # noqa: F401
+        import search  # noqa: F401
+    with timer.measure("instantiate bots"):
+        chat_bot.ReceptionChatBot()
+        chat_bot.HardCodedBouncerBot(stop_phrases=["start search"])
+        chat_bot.ReceptionSummarizerBot()
+    with timer.measure("search database (total)"):
+        get_search_algo()
+    print(timer.report())